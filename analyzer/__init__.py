@@ -32,8 +32,8 @@ USERNAME = CFG.get(MACHINE_NAME, 'USERNAME')
 
 HOST = Host(hostname=HOSTNAME, port=PORT, username=USERNAME)
 
-# Configure logging
-dictConfig({
+# Configure logging, but only once per process. Reconfiguring walks every existing logger.
+_LOGGING_CONFIG = {
     'version': 1,
     'formatters': {
         'default': {
@@ -67,7 +67,11 @@ dictConfig({
         'level': LOG_LEVEL,
         'handlers': ['wsgi']
     }
-})
+}
+# A reload runs this again but keeps the module's globals, so the flag survives it.
+if not globals().get('_LOGGING_CONFIGURED'):
+    dictConfig(_LOGGING_CONFIG)
+    _LOGGING_CONFIGURED = True
 
 
 from .system import *
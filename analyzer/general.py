@@ -6,11 +6,6 @@ GeneralAnalyzer begins from no knowledge and sets up an environment to look at a
 '''
 
 import logging
-import re
-
-import docker
-from paramiko import AutoAddPolicy, SSHClient
-from paramiko.ssh_exception import NoValidConnectionsError
 
 from . import HOST
 from .utils import OpSysError, OrigSysConnError, PermissionsError
@@ -18,24 +13,52 @@ from .system.centos import CentosAnalyzer
 from .system.ubuntu import UbuntuAnalyzer
 
 
+# Which SystemAnalyzer child class handles each value of ID in /etc/os-release
+ANALYZERS = {'centos': CentosAnalyzer, 'ubuntu': UbuntuAnalyzer}
+# Separates /etc/os-release from the package listing in get_os
+OS_SENTINEL = '__OS_RELEASE_END__'
+# SSH flow control window for each channel. paramiko's default stalls big outputs (file listings,
+# hashes) waiting on window adjustments.
+SSH_WINDOW_SIZE = 2**22
+# Seconds between keepalives, so the connection survives long stretches of Docker-only work
+SSH_KEEPALIVE = 30
+
 
 class GeneralAnalyzer:
     '''Does all analysis of an SSHable system that you know nothing about.'''
     def __init__(self, host=HOST, auto_add=False):
+        # paramiko and docker are slow to import, so only pull them in once we need them.
+        # pylint: disable=import-outside-toplevel
+        from paramiko import AutoAddPolicy, SSHClient
+
         self.ssh_client = SSHClient()
         if auto_add:
             self.ssh_client.set_missing_host_key_policy(AutoAddPolicy())
         self.host = host
 
-        self.docker_client = docker.from_env()
+        self._docker_client = None
 
         self.op_sys = None
         self.version = None
+        # LIST_INSTALLED output grabbed alongside the OS, handed to the analyzer
+        self.package_listing = None
 
         self.analyzer = None
 
 
+    @property
+    def docker_client(self):
+        '''The Docker client, connected on first use.'''
+        if self._docker_client is None:
+            import docker # pylint: disable=import-outside-toplevel
+            self._docker_client = docker.from_env()
+        return self._docker_client
+
+
     def __enter__(self):
+        # pylint: disable=import-outside-toplevel
+        from paramiko.ssh_exception import NoValidConnectionsError
+
         # Get keys that are already loaded on the investigating system
         self.ssh_client.load_system_host_keys()
         # Establish SSH connection
@@ -44,12 +67,16 @@ class GeneralAnalyzer:
                                     username=self.host.username)
         except NoValidConnectionsError:
             raise OrigSysConnError("Can't connect to the system you want to replicate. Is it up?")
+        transport = self.ssh_client.get_transport()
+        # Channels opened from here on get the bigger window
+        transport.default_window_size = SSH_WINDOW_SIZE
+        transport.set_keepalive(SSH_KEEPALIVE)
 
         # Verify permissions on original system
         # NOTE: In future you might be able to extend this to accept sudo-happy users, not just
         # literally root.
         _, stdout, _ = self.ssh_client.exec_command(f'sudo -v')
-        for line in stdout:
+        for line in stdout.read().decode('utf-8', errors='replace').splitlines():
             logging.error(line.strip())
             if line == "":
                 continue
@@ -65,26 +92,38 @@ class GeneralAnalyzer:
 
     def __exit__(self, *args):
         # Make sure you kill the connection when you're done
+        if self.analyzer:
+            self.analyzer.close()
         self.ssh_client.close()
 
 
     def get_os(self):
         '''
-        Gets the operating system and version of the target system.
+        Gets the operating system and version of the target system. In the same SSH exec, also lists
+        the installed packages with the matching analyzer's LIST_INSTALLED, so that get_packages
+        doesn't need another round trip.
         '''
         logging.info("Getting operating system and version...")
-        _, stdout, _ = self.ssh_client.exec_command('cat /etc/os-release')
+        cases = " ".join(f"{op_sys}) {analyzer.LIST_INSTALLED} ;;"
+                         for op_sys, analyzer in ANALYZERS.items())
+        cmd = (f"cat /etc/os-release; echo {OS_SENTINEL}; "
+               f". /etc/os-release; case \"$ID\" in {cases} esac")
+        _, stdout, _ = self.ssh_client.exec_command(cmd)
+        os_release, _, listing = stdout.read().decode().partition(f"{OS_SENTINEL}\n")
 
         # Extract operating system and version
-        for line in stdout:
-            if re.match(r'VERSION_ID=', line):
-                line = line.strip().replace('"', '')
-                version = line.split('=')[1]
-            elif re.match(r'ID=', line):
-                line = line.strip().replace('"', '')
-                op_sys = line.split('=')[1]
+        op_sys = None
+        version = None
+        for line in os_release.splitlines():
+            if line.startswith('VERSION_ID='):
+                version = line[len('VERSION_ID='):].strip().strip('"')
+            elif line.startswith('ID='):
+                op_sys = line[len('ID='):].strip().strip('"')
+            if op_sys and version:
+                break
         self.op_sys = op_sys
         self.version = version
+        self.package_listing = listing.splitlines() if listing else None
 
 
     def get_analyzer(self):
@@ -92,12 +131,11 @@ class GeneralAnalyzer:
         Creates an instance of the applicable SystemAnalyzer child class based on
         self.op_sys.
         '''
-        if self.op_sys == 'centos':
-            self.analyzer = CentosAnalyzer(self.ssh_client, self.docker_client, self.op_sys,
-                                           self.version)
-        elif self.op_sys == 'ubuntu':
-            self.analyzer = UbuntuAnalyzer(self.ssh_client, self.docker_client, self.op_sys,
-                                           self.version)
-        else:
+        try:
+            analyzer = ANALYZERS[self.op_sys]
+        except KeyError:
             raise OpSysError(f"Unknown operating system {self.op_sys}. This likely means we "\
                              f"haven't written a SystemAnalyzer child class for this system yet.")
+        self.analyzer = analyzer(self.ssh_client, self.docker_client, self.op_sys, self.version)
+        # Saves get_packages a round trip
+        self.analyzer.package_listing = self.package_listing
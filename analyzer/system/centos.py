@@ -6,8 +6,6 @@ import logging
 import os
 import re
 
-import requests.exceptions
-
 from .system import SystemAnalyzer
 from ..utils import group_strings
 
@@ -18,39 +16,48 @@ class CentosAnalyzer(SystemAnalyzer):
     '''
     Inherits from SystemAnalyzer to provide functions for analyzing CentOS/yum style systems.
     '''
-    LIST_INSTALLED = 'yum list installed -d 0'
+    # rpm reads the local database directly; yum list installed starts all of yum and its repos
+    LIST_INSTALLED = "rpm -qa --queryformat '%{NAME} %{VERSION}\\n'"
+    # A line of LIST_INSTALLED output: exactly a name and a version
+    PKG_PATTERN = re.compile(r'^[ \t]*(\S+)[ \t]+(\S+)[ \t]*$', re.MULTILINE)
 
 
     @staticmethod
-    def parse_pkg_line(line):
+    def parse_all_pkgs(iterable):
         '''
-        Parses yum-style package lines.
-        Returns a tuple of package name, package version.
+        Parses an iterable of LIST_INSTALLED output, i.e. lines of the form 'curl 7.29.0'.
+        Returns a dictionary of package versions keyed on package name.
         '''
-        #assumes line comes in as something like 'curl.x86_64   [1:]7.29.0-42.el7'
-        clean_line = line.strip().split(maxsplit=2)
-        name = clean_line[0] #curl.x86_64
-        name = name.rsplit(sep='.', maxsplit=1)[0]   #curl
-        ver = clean_line[1] #1:7.29.0-42.el7
-        ver = ver.split(sep='-', maxsplit=2)[0]    #1:7.29.0
-        # If epoch number exists, get rid of it.
-        ver = ver.split(':')[-1] #7.29.0
-        return (name, ver)
+        # Scan all of the output in one go rather than splitting it line by line. Blank lines and
+        # anything else that isn't a name/version pair don't match.
+        packages = dict(CentosAnalyzer.PKG_PATTERN.findall('\n'.join(iterable)))
+        # rpm lists each imported GPG key as a gpg-pubkey package, which yum can't install
+        packages.pop('gpg-pubkey', None)
+        return packages
 
+    @staticmethod
+    def parse_bulk_query(iterable):
+        '''
+        Parses an iterable of rpm query output where each package's output is preceded by a line of
+        the form __SEP__pkg__.
+        Returns a dictionary of sets of output lines keyed on package name. rpm's message for a
+        package with nothing to list is left out.
+        '''
+        return {package: {line.strip() for line in lines if line.strip()} - {'(contains no files)'}
+                for package, lines in CentosAnalyzer._split_framed(iterable).items()}
 
     @staticmethod
-    def parse_all_pkgs(iterable):
+    def parse_file_listing(output, count):
         '''
-        Parses an iterable of yum list installed -d 0 style output.
-        Returns a dictionary of package versions keyed on package name.
+        Parses rpm -ql output where each package's files are preceded by a line of the form
+        __PKG__index__, index being the package's position in the list we asked about.
+        output -- the raw output, as one string
+        count -- the number of packages we asked about
+        Returns a list of lists of filenames, one per package.
         '''
-        packages = {}
-        for line in iterable:
-            if re.match(r'Installed Packages', line):
-                continue
-            pkg_name, pkg_ver = CentosAnalyzer.parse_pkg_line(line)
-            packages[pkg_name] = pkg_ver
-        return packages
+        return [[line for line in lines if line and "is not installed" not in line
+                 and "contains no files" not in line]
+                for lines in CentosAnalyzer._split_file_listing(output, count)]
 
     def list_files_in_packages(self, pkgs):
         '''
@@ -58,53 +65,22 @@ class CentosAnalyzer(SystemAnalyzer):
         Gets the list of files installed as part of each package.
         Returns a list of lists of filenames.
         '''
-        files = [[]] * len(pkgs)
-        i = 0
-        pkg_strings = group_strings(pkgs)
-        cmd_strings = []
-        for pkg_string in pkg_strings:
-            cmd_string = ""
-            for pkg in pkg_string.split():
-                cmd_string += f" && echo \"\" && rpm -ql {pkg}"
-            cmd_strings.append(cmd_string[15:])
-
-        temp = []
-        for cmd in cmd_strings:
-            _, stdout, _ = self.ssh_client.exec_command(cmd)
-            for line in stdout:
-                line = line.strip()
-                if re.search("is not installed", line):
-                    # Do nothing
-                    ...
-                elif re.search("contains no files", line):
-                    # Do nothing
-                    ...
-                elif line == '':
-                    files[i] = temp
-                    temp = []
-                    i += 1
-                else:
-                    temp.append(line)
-            files[i] = temp
-            temp = []
-            i += 1
-
-        return files
+        return self._list_files(pkgs, 'rpm -ql', CentosAnalyzer.parse_file_listing)
 
     def files_changed_from_package(self, pkg):
         '''
-        Returns the list of files coming from pkg whose checksums don't match their original
+        Returns the set of files coming from pkg whose checksums don't match their original
         checksums.
         '''
-        files = []
-        _, stdout, _ = self.ssh_client.exec_command(f"rpm -V {pkg}")
+        files = set()
+        stdout = self.pool.run(f"rpm -V {pkg}")
         for line in stdout:
-            if re.search("is not installed", line):
-                return []
-            if re.search("contains no files", line):
-                return []
+            if "is not installed" in line:
+                return set()
+            if "contains no files" in line:
+                return set()
             if '5' in line.split()[0]:
-                files.append(line.split()[2].strip())
+                files.add(line.split()[2].strip())
         return files
 
 
@@ -113,11 +89,9 @@ class CentosAnalyzer(SystemAnalyzer):
         Gets all packages and versions from the target system.
         '''
         super().get_packages()
-        _, stdout, _ = self.ssh_client.exec_command(CentosAnalyzer.LIST_INSTALLED)
-        self.all_packages = CentosAnalyzer.parse_all_pkgs(stdout)
-        # Note that this is a shallow copy; if you add more info to the dictionaries later on,
-        # you'll have to change this.
-        self.install_packages = self.all_packages.copy()
+        self.all_packages = CentosAnalyzer.parse_all_pkgs(self._list_installed())
+        # Share all_packages until something actually removes a package from the install list
+        self.install_packages = None
         logging.debug(self.all_packages)
 
 
@@ -127,9 +101,9 @@ class CentosAnalyzer(SystemAnalyzer):
         package -- the package to get deps for
         '''
         super().get_dependencies(package)
-        _, stdout, _ = self.ssh_client.exec_command(f"rpm -qR {package}")
-        deps = {line.strip() for line in stdout}
-        logging.debug(f"{package} > {deps}")
+        stdout = self.pool.run(f"rpm -qR {package}")
+        deps = {dep for dep in (line.strip() for line in stdout) if dep}
+        logging.debug("%s > %s", package, deps)
         return deps
 
 
@@ -139,15 +113,50 @@ class CentosAnalyzer(SystemAnalyzer):
         package -- the pacakge whose configurations we are interested in
         '''
         super().get_config_files_for(package)
-        _, stdout, _ = self.ssh_client.exec_command(f"rpm -qc {package}")
-        configs = {line.strip() for line in stdout}
+        stdout = self.pool.run(f"rpm -qc {package}")
+        configs = {config for config in (line.strip() for line in stdout) if config}
         # This is an alias for no files.
-        if '(contains no files)' in configs:
-            configs = set()
-        logging.debug(f"{package} has the following config files: {configs}")
+        configs.discard('(contains no files)')
+        logging.debug("%s has the following config files: %s", package, configs)
         return configs
 
 
+    def _rpm_query_bulk(self, flag, packages, log_format):
+        '''
+        Runs rpm with the given query flag over many packages, batching as many packages as
+        possible into each SSH exec. Output for each package is framed by a sentinel line.
+        Returns a dictionary of sets of output lines keyed on package name.
+        flag -- the rpm query flag to use (e.g. -qR)
+        packages -- iterable of packages to query
+        log_format -- what to log each package's output with; see _run_batched
+        '''
+        cmds = group_strings((f"echo {CentosAnalyzer.SENTINEL}{pkg}__ ; rpm {flag} {pkg}"
+                              for pkg in packages), sep=' ; ')
+        return self._run_batched(cmds, CentosAnalyzer.parse_bulk_query, log_format)
+
+
+    def get_dependencies_bulk(self, packages):
+        '''
+        Gets the dependencies of many packages on the target system in as few SSH execs as possible.
+        (Currently uses rpm.)
+        packages -- iterable of packages to get deps for
+        Returns a dictionary of sets of dependencies keyed on package name.
+        '''
+        logging.debug(f"Getting dependencies for {len(packages)} packages...")
+        return self._rpm_query_bulk('-qR', packages, "%s > %s")
+
+
+    def get_config_files_bulk(self, packages):
+        '''
+        Gets the configuration files of many packages on the target system in as few SSH execs as
+        possible.
+        packages -- iterable of packages whose configurations we are interested in
+        Returns a dictionary of sets of file paths keyed on package name.
+        '''
+        logging.debug(f"Getting configuration files associated with {len(packages)} packages...")
+        return self._rpm_query_bulk('-qc', packages, "%s has the following config files: %s")
+
+
     def dockerize(self, folder, verbose=True):
         '''
         Creates Dockerfile from parameters discovered by the class.
@@ -157,31 +166,32 @@ class CentosAnalyzer(SystemAnalyzer):
         verbose -- whether to emit log statements
         '''
         super().dockerize(folder, verbose)
+        lines = [f"FROM {self.base_image}"]
+
+        # Normal installs
+        if self.install_packages:
+            install_parts = [f"{name}-{ver}" if ver else name
+                             for name, ver in self.install_packages.items()]
+            lines.append("RUN yum -y install " + " ".join(install_parts))
+
+        # Unversioned packages: original ver in comment, installed ver in yum line
+        if self.unversion_packages:
+            comment_parts = []
+            install_parts = []
+            for name, new_ver in self.unversion_packages.items():
+                old_ver = self.all_packages[name]
+                if new_ver:
+                    comment_parts.append(f"{name}: {old_ver}->{new_ver}")
+                    install_parts.append(f"{name}-{new_ver}")
+                else:
+                    comment_parts.append(f"{name}: {old_ver}->?")
+                    install_parts.append(name)
+            lines.append("# Original versions: " + " ".join(comment_parts))
+            lines.append("RUN yum -y install " + " ".join(install_parts))
+
+        # Write the whole file in one go
         with open(os.path.join(folder, 'Dockerfile'), 'w') as dockerfile:
-            dockerfile.write(f"FROM {self.op_sys}:{self.version}\n")
-
-            # Normal installs
-            if self.install_packages:
-                dockerfile.write(f"RUN yum -y install ")
-                for name, ver in self.install_packages.items():
-                    if ver:
-                        dockerfile.write(f"{name}-{ver} ")
-                dockerfile.write("\n")
-
-            # Unversioned packages: original ver in comment, installed ver in yum line
-            if self.unversion_packages:
-                comment = "# Original versions: "
-                install_line = "RUN yum -y install "
-                for name, new_ver in self.unversion_packages.items():
-                    old_ver = self.all_packages[name]
-                    if new_ver:
-                        comment += f"{name}: {old_ver}->{new_ver} "
-                        install_line += f"{name}-{new_ver} "
-                    else:
-                        comment += f"{name}: {old_ver}->? "
-                        install_line += f"{name} "
-                dockerfile.write(comment + '\n')
-                dockerfile.write(install_line + '\n')
+            dockerfile.write("\n".join(lines) + "\n")
 
         if verbose:
             logging.info(f"Your Dockerfile is in {folder}")
@@ -0,0 +1,483 @@
+'''
+FileComparerMixin is a mixin for SystemAnalyzer that lists, stats, and checksums files on both the
+VM and the container so that the two can be compared.
+'''
+
+import hashlib
+import io
+import json
+import logging
+import os
+import shlex
+import tarfile
+import tempfile
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from ..utils import FileHash
+
+
+
+class FileComparerMixin:
+    '''
+    Mixin for SystemAnalyzer holding its file comparison machinery. Relies on the analyzer's
+    ssh_client, image, _get_sidecar, and _stream_from_sidecar, and keeps its results in
+    vm_hashes and container_hashes.
+    '''
+    # Name of the file in /tmp on the container listing the paths for hash_files_on_container
+    PATH_LIST_NAME = 'pure19_paths'
+    # Commands we can checksum files with, most preferred first. xxHash is much faster than cksum's
+    # CRC on large files, and sha256sum is hardware accelerated on most current CPUs. cksum goes
+    # last since every system has it.
+    HASHERS = ('xxh128sum', 'xxh64sum', 'sha256sum', 'cksum')
+    # Hashers whose output we can reproduce with hashlib, and the algorithm to use
+    HASHLIB_HASHERS = {'sha256sum': 'sha256'}
+    # Tree that, when many files in it need hashing on the container, gets copied out in one archive
+    # and hashed locally instead; most config files live here
+    ARCHIVE_HASH_ROOT = '/etc'
+    ARCHIVE_HASH_MIN = 100
+    # stat output used to rule files in or out before hashing them: size, mtime, path
+    STAT_FORMAT = '%s %Y %n'
+    # Directory (under the user's cache directory) that container hashes are cached in between runs
+    HASH_CACHE_DIR = os.path.join('pure19', 'hashes')
+
+    def __init__(self):
+        # Keyed on path, each contains a FileHash
+        self.vm_hashes = {}
+        self.container_hashes = {}
+        # Command both sides checksum files with; see _get_hasher
+        self._hasher = None
+        # ID of the image whose hashes self.container_hashes holds; see _load_hash_cache
+        self._hash_cache_image_id = None
+
+
+    def get_hash_from_container(self, filepath, is_directory=False):
+        '''
+        Given a filepath, returns a checksum of the indicated file.
+        You may also pass a space-separated list of files.
+        If your path is a directory, it must end in a slash. I don't check for this but you gotta.
+        If is_directory is True, go into subdirectories, else assume it is a single file.
+        Target docker image must have cksum available for use.
+        Must be called after verify_packages, as it relies on the container having
+        already been built and its packages installed.
+        '''
+        if not filepath:
+            logging.warning("Please pass a filepath.")
+            return None
+        logging.debug(f"Hashing filepath {filepath} from the container...")
+
+        hasher = self._get_hasher()
+        if is_directory:
+            lines = self._stream_from_sidecar(f"find {filepath} -type f -exec {hasher} '{{}}' \\;")
+        else:
+            lines = self._stream_from_sidecar(f"{hasher} {filepath}")
+        # Missing or unreadable files only show up on stderr, so they're skipped.
+        crc = self._record_hashes(lines, self.container_hashes, hasher)
+        if is_directory:
+            # In this case, the returned hash would just be the last thing hashed; not
+            # meaningful, so don't return it.
+            return None
+        return crc
+
+
+    def get_hash_from_vm(self, filepath, is_directory=False):
+        '''
+        Given a filepath, returns a checksum of the indicated file from a VM.
+        You may also pass a space-separated list of files.
+        If your path is a directory, it must end in a slash. I don't check for this but you gotta.
+        If is_directory is True, go into subdirectories, else assume it is a single file.
+        '''
+        if not filepath:
+            logging.warning("Please pass a filepath.")
+            return None
+        logging.debug(f"Hashing file {filepath} from the VM...")
+        hasher = self._get_hasher()
+        if is_directory:
+            _, stdout, _ = self.ssh_client.exec_command(f"find {filepath} -type f "
+                                                        f"-exec {hasher} '{{}}' \\;")
+        else:
+            _, stdout, _ = self.ssh_client.exec_command(f'{hasher} {filepath}')
+        # Couldn't find the file. This is expected to happen sometimes; just keep going.
+        # Read everything in one go rather than a receive per line
+        lines = [line for line in stdout.read().decode().splitlines() if 'No such file' not in line]
+        crc = self._record_hashes(lines, self.vm_hashes, hasher)
+        if is_directory:
+            # In this case, the returned hash would just be the last thing hashed; not meaningful,
+            # so don't return it.
+            return None
+        return crc
+
+
+    def _get_hasher(self):
+        '''
+        Returns the command used to checksum files: the first of HASHERS that both the VM and the
+        container have. Both sides have to agree, or none of their hashes would ever match. Checked
+        once; cksum is POSIX, so it's always there to fall back on.
+        '''
+        if self._hasher is None:
+            # Ask each side about all the candidates at once; command -v prints the ones it finds
+            probe = (f"for hasher in {' '.join(FileComparerMixin.HASHERS[:-1])}; "
+                     "do command -v $hasher; done")
+            _, stdout, _ = self.ssh_client.exec_command(probe)
+            on_vm = {os.path.basename(line) for line in stdout.read().decode().split()}
+            on_container = {os.path.basename(line.strip())
+                            for line in self._stream_from_sidecar(["sh", "-c", probe])}
+            self._hasher = next((hasher for hasher in FileComparerMixin.HASHERS[:-1]
+                                 if hasher in on_vm and hasher in on_container), 'cksum')
+            logging.debug(f"Hashing files with {self._hasher}")
+        return self._hasher
+
+
+    @staticmethod
+    def _record_hashes(lines, hashes, hasher='cksum'):
+        '''
+        Parses lines of hasher output into hashes, a dictionary keyed on path where each entry is
+        a FileHash. Only cksum reports sizes; for other hashers size is None.
+        Returns the last hash recorded, or None if there were none.
+        '''
+        # Paths may contain spaces, so only split off the leading fields
+        maxsplit = 2 if hasher == 'cksum' else 1
+        fields = [line.split(maxsplit=maxsplit)
+                  for line in (raw.rstrip('\n') for raw in lines) if line]
+        try:
+            if hasher == 'cksum':
+                parsed = {file: FileHash(crc, size) for crc, size, file in fields}
+            else:
+                parsed = {file: FileHash(crc, None) for crc, file in fields}
+        except ValueError:
+            bad = next(field for field in fields if len(field) != maxsplit + 1)
+            logging.error(f"Unexpected number of values returned from line: {bad}")
+            raise
+        hashes.update(parsed)
+        return fields[-1][0] if fields else None
+
+
+    def hash_files_on_container(self, paths):
+        '''
+        Checksums all of paths on the container in a single exec and records the results in
+        self.container_hashes. Files that can't be read are skipped.
+        Must be called after verify_packages, as it relies on the container having already been
+        built and its packages installed.
+        paths -- iterable of absolute file paths
+        '''
+        # Anything already hashed in this image can't have changed
+        self._load_hash_cache()
+        uncached = [path for path in paths if path not in self.container_hashes]
+        listing = '\0'.join(uncached).encode()
+        if listing:
+            self._hash_paths_on_container(uncached, self._get_hasher(), listing)
+            self._save_hash_cache()
+
+
+    def _hash_paths_on_container(self, paths, hasher, listing):
+        '''
+        Checksums paths on the container. If there are enough of them under ARCHIVE_HASH_ROOT and
+        we can compute the hasher's hashes ourselves, that whole tree gets copied out in one archive
+        and hashed here; the rest are hashed by exec as usual.
+        paths -- list of absolute file paths
+        hasher -- the checksum command to use
+        listing -- paths, NUL-separated, as bytes
+        '''
+        algorithm = FileComparerMixin.HASHLIB_HASHERS.get(hasher)
+        prefix = FileComparerMixin.ARCHIVE_HASH_ROOT + '/'
+        if algorithm:
+            in_root = {path for path in paths if path.startswith(prefix)}
+            if len(in_root) >= FileComparerMixin.ARCHIVE_HASH_MIN:
+                self._hash_archive_on_container(in_root, algorithm)
+                # Anything the archive didn't cover (symlinks, say) still gets hashed by exec
+                listing = '\0'.join(path for path in paths
+                                     if path not in self.container_hashes).encode()
+        if listing:
+            self._hash_listing_on_container(listing, hasher)
+
+
+    def _hash_archive_on_container(self, paths, algorithm):
+        '''
+        Copies ARCHIVE_HASH_ROOT out of the container as one tar stream and hashes the regular
+        files in it that are in paths, recording them in self.container_hashes.
+        paths -- set of absolute file paths under ARCHIVE_HASH_ROOT
+        algorithm -- the hashlib algorithm matching the hasher the VM uses
+        '''
+        root = FileComparerMixin.ARCHIVE_HASH_ROOT
+        logging.debug(f"Hashing {len(paths)} files under {root} from a container archive...")
+        chunks, _ = self._get_sidecar().get_archive(root)
+        # Members are named relative to root's parent, e.g. etc/hosts
+        parent = os.path.dirname(root)
+        with tarfile.open(fileobj=io.BytesIO(b"".join(chunks)), mode='r|') as tar:
+            for member in tar:
+                path = os.path.join(parent, member.name)
+                if member.isfile() and path in paths:
+                    digest = hashlib.new(algorithm, tar.extractfile(member).read()).hexdigest()
+                    self.container_hashes[path] = FileHash(digest, None)
+
+
+    def _hash_listing_on_container(self, listing, hasher):
+        '''
+        Does the work for hash_files_on_container.
+        listing -- the NUL-separated paths to checksum, as bytes
+        hasher -- the checksum command to use
+        '''
+        logging.debug("Hashing files from the container...")
+        lines = self._xargs_on_container(listing, hasher)
+        self._record_hashes(lines, self.container_hashes, hasher)
+
+
+    def _xargs_on_container(self, listing, command):
+        '''
+        Runs command on the container over all of listing with xargs, in a single exec.
+        listing -- the NUL-separated paths to pass to command, as bytes
+        command -- the command to run; the paths get appended to it
+        Returns an iterator over the lines it writes to stdout.
+        '''
+        # Ship the path list into the container and let xargs do the batching
+        tar_bytes = io.BytesIO()
+        with tarfile.open(fileobj=tar_bytes, mode='w') as tar:
+            info = tarfile.TarInfo(FileComparerMixin.PATH_LIST_NAME)
+            info.size = len(listing)
+            tar.addfile(info, io.BytesIO(listing))
+
+        self._get_sidecar().put_archive('/tmp', tar_bytes.getvalue())
+        # Clean up the list afterwards so later file comparisons don't see it
+        list_path = f"/tmp/{FileComparerMixin.PATH_LIST_NAME}"
+        return self._stream_from_sidecar(["sh", "-c",
+                                          f"xargs -0 {command} < {list_path}; rm -f {list_path}"])
+
+
+    def hash_files_on_vm(self, paths):
+        '''
+        Checksums all of paths on the VM in a single SSH exec and records the results in
+        self.vm_hashes. Files that can't be read are skipped.
+        paths -- iterable of absolute file paths
+        '''
+        listing = '\0'.join(paths).encode()
+        if listing:
+            self._hash_listing_on_vm(listing, self._get_hasher())
+
+
+    def _hash_listing_on_vm(self, listing, hasher):
+        '''
+        Does the work for hash_files_on_vm.
+        listing -- the NUL-separated paths to checksum, as bytes
+        hasher -- the checksum command to use
+        '''
+        logging.debug("Hashing files from the VM...")
+        lines = self._xargs_on_vm(listing, hasher)
+        self._record_hashes(lines, self.vm_hashes, hasher)
+
+
+    def _xargs_on_vm(self, listing, command):
+        '''
+        Runs command on the VM over all of listing with xargs, in a single SSH exec.
+        listing -- the NUL-separated paths to pass to command, as bytes
+        command -- the command to run; the paths get appended to it
+        Returns a list of the lines it writes to stdout.
+        '''
+        stdin, stdout, _ = self.ssh_client.exec_command(f"xargs -0 {command} 2>/dev/null")
+
+        # Feed the path list from another thread so that a full output window can't deadlock us
+        def feed():
+            stdin.write(listing)
+            stdin.channel.shutdown_write()
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        lines = stdout.read().decode().splitlines()
+        feeder.join()
+        return lines
+
+
+    def hash_files_on_both(self, paths):
+        '''
+        Checksums all of paths on both the VM and the container at the same time, since the two
+        don't depend on each other. Results go in self.vm_hashes and self.container_hashes.
+        paths -- collection of absolute file paths
+        '''
+        listing = '\0'.join(paths).encode()
+        if not listing:
+            return
+        # Anything already hashed in this image can't have changed. If nothing was, both sides get
+        # the same list, so only build it once.
+        self._load_hash_cache()
+        uncached = [path for path in paths if path not in self.container_hashes]
+        if len(uncached) == len(paths):
+            container_listing = listing
+        else:
+            container_listing = '\0'.join(uncached).encode()
+        # Pick the hasher up front, rather than letting both threads go looking for it
+        hasher = self._get_hasher()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(self._hash_listing_on_vm, listing, hasher)]
+            if container_listing:
+                futures.append(executor.submit(self._hash_paths_on_container, uncached, hasher,
+                                               container_listing))
+            for future in futures:
+                # Raise anything that went wrong in either
+                future.result()
+        if container_listing:
+            self._save_hash_cache()
+
+
+    @staticmethod
+    def _parse_stats(lines):
+        '''
+        Parses lines of STAT_FORMAT output.
+        Returns a dictionary of (size, mtime) tuples keyed on path.
+        '''
+        stats = {}
+        for line in lines:
+            # Paths may contain spaces, so only split off the first two fields
+            fields = line.rstrip('\n').split(maxsplit=2)
+            if len(fields) == 3:
+                stats[fields[2]] = (fields[0], fields[1])
+        return stats
+
+
+    def stat_files_on_both(self, paths):
+        '''
+        Gets the size and modification time of all of paths on both the VM and the container, one
+        exec per side, at the same time. Files that can't be read are left out.
+        paths -- iterable of absolute file paths
+        Returns a tuple of dictionaries of (size, mtime) tuples keyed on path: one for the VM, then
+        one for the container.
+        '''
+        listing = '\0'.join(paths).encode()
+        if not listing:
+            return {}, {}
+        command = f"stat -c '{FileComparerMixin.STAT_FORMAT}' --"
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            vm_future = executor.submit(self._xargs_on_vm, listing, command)
+            container_future = executor.submit(
+                lambda: list(self._xargs_on_container(listing, command)))
+            return (self._parse_stats(vm_future.result()),
+                    self._parse_stats(container_future.result()))
+
+
+    def _hash_cache_path(self):
+        '''
+        Returns the path of the file container hashes for the current image are cached in. It lives
+        in the user's own cache directory, not a shared one like /tmp, so that nobody else can plant
+        hashes in it.
+        '''
+        cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'),
+                                                                      '.cache')
+        image_id = self.image.id.split(':')[-1][:12]
+        return os.path.join(cache_home, FileComparerMixin.HASH_CACHE_DIR,
+                            f"{image_id}-{self._get_hasher()}.json")
+
+
+    @staticmethod
+    def _is_private(path):
+        '''
+        Returns True if path belongs to the current user and nobody else can write to it.
+        '''
+        info = os.stat(path)
+        return info.st_uid == os.getuid() and not info.st_mode & 0o022
+
+
+    def _load_hash_cache(self):
+        '''
+        Makes self.container_hashes hold the hashes for the current image, reading in any that an
+        earlier run cached. Images are immutable, so cached hashes never go stale. (The VM's files
+        can change at any time, so its hashes never get cached.)
+        '''
+        if self._hash_cache_image_id == self.image.id:
+            return
+        if self._hash_cache_image_id is not None:
+            # Hashes from another image don't apply to this one
+            self.container_hashes = {}
+        self._hash_cache_image_id = self.image.id
+        path = self._hash_cache_path()
+        try:
+            # Anyone who could write the cache could make changed files look unchanged
+            if not (self._is_private(os.path.dirname(path)) and self._is_private(path)):
+                logging.warning(f"Ignoring container hash cache {path}: someone else can write it")
+                return
+            with open(path) as cache:
+                # JSON turns each FileHash into a [hash, size] list
+                cached = {file: FileHash(*entry) for file, entry in json.load(cache).items()}
+        except (OSError, ValueError, TypeError, AttributeError):
+            # No cache yet, or an unreadable one; just hash everything
+            return
+        logging.debug(f"Loaded {len(cached)} cached container hashes.")
+        cached.update(self.container_hashes)
+        self.container_hashes = cached
+
+
+    def _save_hash_cache(self):
+        '''
+        Writes self.container_hashes out for later runs against the same image. Failing to write it
+        only costs time later, so errors are just logged.
+        '''
+        path = self._hash_cache_path()
+        try:
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+            if not self._is_private(os.path.dirname(path)):
+                logging.warning(f"Not caching container hashes: someone else can write to "
+                                f"{os.path.dirname(path)}")
+                return
+            # Write to the side and swap it in, so that a concurrent run never reads half a file
+            with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), delete=False) as cache:
+                json.dump(self.container_hashes, cache)
+            os.replace(cache.name, path)
+        except OSError as err:
+            logging.warning(f"Could not cache container hashes: {err}")
+
+
+    def _list_names_on_vm(self, command, location):
+        '''
+        Runs compare_names' find command in location on the VM.
+        Returns the set of absolute paths it found.
+        '''
+        # Every name starts with ./, so swap the . for the location.
+        root = location.rstrip('/')
+        _, vm_out, _ = self.ssh_client.exec_command(f"cd {shlex.quote(location)} && {command}")
+        return {root + name[1:] for name in vm_out.read().decode().split('\0') if name}
+
+
+    def _list_names_on_container(self, command, location):
+        '''
+        Runs compare_names' find command in location on the container.
+        Returns the set of absolute paths it found.
+        '''
+        root = location.rstrip('/')
+        # TODO: selinux seems to break things; ignoring for now. See #60
+        return {root + name[1:]
+                for name in self._stream_from_sidecar(command, workdir=location, sep='\0')
+                if name and ": Permission denied" not in name}
+
+
+    def compare_names(self, location='/', blocklist=None):
+        '''
+        Compares names of the entire system, excluding anything in the (absolute) paths in the
+        blocklist.
+        Blocklist paths may go to folders, in which case they must be formatted /path/folder/*
+        Otherwise, they may go to files, in which case they must be formatted /path/file
+        Returns a tuple of filenames only on the container, filenames on both, and filenames only on
+        the VM.
+        '''
+        # Strip trailing slashes from location; blocklisted paths get rewritten relative to it
+        root = location.rstrip('/')
+        prune_exprs = []
+        if blocklist:
+            for place in blocklist:
+                if not root or place == root or place.startswith(root + '/'):
+                    prune_exprs.append(f"-path {shlex.quote('.' + place[len(root):])}")
+        # Prune blocklisted paths so find never descends into them. Names are NUL-separated so
+        # that spaces and newlines in them survive.
+        if prune_exprs:
+            command = f"find . \\( {' -o '.join(prune_exprs)} \\) -prune -o -type f -print0"
+        else:
+            command = "find . -type f -print0"
+        logging.debug(f"Running command: cd {location} && {command}")
+
+        # The two listings don't depend on each other, so run them at the same time
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            vm_future = executor.submit(self._list_names_on_vm, command, location)
+            docker_future = executor.submit(self._list_names_on_container, command, location)
+            vm_filenames = vm_future.result()
+            docker_filenames = docker_future.result()
+        logging.debug(f"The total number of files in the VM is {len(vm_filenames)}")
+        logging.debug(f"The total number of files in the container is {len(docker_filenames)}")
+        return (docker_filenames - vm_filenames,
+                vm_filenames & docker_filenames,
+                vm_filenames - docker_filenames)
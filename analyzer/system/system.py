@@ -3,43 +3,68 @@ SystemAnalyzer is an abstract base class which may be extended to create more sp
     for certain OSs or package managers.
 '''
 
+import codecs
+import hashlib
 import json
 import logging
-import re
+import os
 import tempfile
 
 from abc import ABC, abstractmethod
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-import requests.exceptions
 
-from ..utils import analyze_dependencies, DockerDaemonError, group_strings
+from .files import FileComparerMixin
+from ..utils import analyze_dependencies, ChannelPool, DockerDaemonError, group_strings
 
 
+# Packages installed by default in each base image (and versions), keyed on image tag; see
+# SystemAnalyzer._get_default_packages
+_DEFAULT_PACKAGES = {}
 
-class SystemAnalyzer(ABC):
+
+
+class SystemAnalyzer(FileComparerMixin, ABC):
     '''
     Does analysis of a system that you know some information about. Use as a base class where child
     classes know about more specific systems.
     '''
     Mode = Enum('Mode', 'dry unversion delete')
+    # Characters of arguments to put in one command if the target system won't tell us its ARG_MAX
+    DEFAULT_ARG_BUDGET = 100000
+    # Marks the start of each package's output when many package queries share one SSH exec
+    SENTINEL = '__SEP__'
+    # Marks the start of each package's file list in list_files_in_packages
+    FILES_SENTINEL = '__PKG__'
 
     def __init__(self, ssh_client, docker_client, op_sys, version):
+        super().__init__()
         self.ssh_client = ssh_client
         self.docker_client = docker_client
+        # Persistent channels for running many small queries on the target system; see close
+        self.pool = ChannelPool(ssh_client)
+        # Lines of LIST_INSTALLED output from the target system, if someone already fetched them;
+        # see _list_installed
+        self.package_listing = None
 
         self.op_sys = op_sys
         self.version = version
-        logging.debug(f"FROM {op_sys}:{version}")
-        try:
-            self.image = self.docker_client.images.pull(f"{op_sys}:{version}")
-        except requests.exceptions.ConnectionError as err:
-            raise DockerDaemonError("Could not reach the Docker daemon. Is it on?")
-        logging.info(f"Pulled {self.image} from Docker hub.")
+        # Tag of the Docker image everything starts from
+        self.base_image = f"{op_sys}:{version}"
+        logging.debug(f"FROM {self.base_image}")
+        # The image analysis runs against; the base image until we build our own. See the image
+        # property.
+        self._image = None
 
         # All packages on the system (and versions)
         self.all_packages = {}
-        # Only (and all) the packages we want to install (and versions)
-        self.install_packages = {}
+        # Only (and all) the packages we want to install (and versions). None means "the same as
+        # all_packages"; see the install_packages property.
+        self._install_packages = None
+        # Answers to per-package queries, keyed on package name; see _cached_query
+        self._dependency_cache = {}
+        self._config_file_cache = {}
         # A list of packages (and their /new/ versions) that we installed on a version
         # number different from the original system
         self.unversion_packages = {}
@@ -47,10 +72,6 @@ class SystemAnalyzer(ABC):
         # A dictionary from packages on the VM to their associated file names
         self.packages_files = {}
 
-        # Keyed on path, each contains dictionary: {'hash': hash, 'size': size}
-        self.vm_hashes = {}
-        self.container_hashes = {}
-
         # Specificallly config file differences
         self.diff_configs = set()
         self.vm_configs = set()
@@ -58,9 +79,122 @@ class SystemAnalyzer(ABC):
 
         self.tempdir = tempfile.mkdtemp()
 
+        # Long-lived container running self.image that we exec commands in; see _get_sidecar
+        self._sidecar = None
+        self._sidecar_image_id = None
+        # Hash of the Dockerfile self.image was last built from; see _build_image
+        self._dockerfile_hash = None
+        # Characters of arguments one command on the target system can take; see _get_arg_budget
+        self._arg_budget = None
+
         self.file_logger = logging.getLogger('filenames')
 
 
+    def _get_sidecar(self):
+        '''
+        Returns a long-lived container running self.image to exec commands in, so we don't pay for
+        a whole container lifecycle per command. Starts a fresh one if self.image has changed.
+        '''
+        if self._sidecar is not None and self._sidecar_image_id != self.image.id:
+            self._remove_sidecar()
+        if self._sidecar is None:
+            self._sidecar = self.docker_client.containers.run(image=self.image.id,
+                                                              command="tail -f /dev/null",
+                                                              detach=True)
+            self._sidecar_image_id = self.image.id
+        return self._sidecar
+
+
+    def _stream_from_sidecar(self, command, workdir=None, sep='\n'):
+        '''
+        Runs command in the sidecar container. Yields the lines the command writes to stdout as they
+        arrive, rather than holding the whole output in memory.
+        sep -- the character that ends each line (e.g. '\\0' for find -print0)
+        '''
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        _, stream = self._get_sidecar().exec_run(command, workdir=workdir, stream=True, demux=True)
+        partial = ''
+        for byteout, _ in stream:
+            if not byteout:
+                continue
+            lines = (partial + decoder.decode(byteout)).split(sep)
+            # The last piece may be the start of a line that continues in the next chunk
+            partial = lines.pop()
+            yield from lines
+        partial += decoder.decode(b'', final=True)
+        if partial:
+            yield partial
+
+
+    def _remove_sidecar(self):
+        '''
+        Removes the sidecar container, if there is one.
+        '''
+        if self._sidecar is not None:
+            self._sidecar.remove(force=True)
+            self._sidecar = None
+
+
+    def close(self):
+        '''
+        Removes the sidecar container, if there is one, and closes the channel pool.
+        '''
+        self._remove_sidecar()
+        self.pool.close()
+
+
+    @property
+    def image(self):
+        '''
+        The Docker image analysis runs against. Starts out as the base image, which is looked up on
+        first use: from the local image cache if it's there, otherwise pulled from Docker hub.
+        '''
+        if self._image is None:
+            # pylint: disable=import-outside-toplevel
+            import requests.exceptions
+            from docker.errors import ImageNotFound
+            try:
+                try:
+                    self._image = self.docker_client.images.get(self.base_image)
+                    logging.info(f"Found {self._image} locally.")
+                except ImageNotFound:
+                    self._image = self.docker_client.images.pull(self.base_image)
+                    logging.info(f"Pulled {self._image} from Docker hub.")
+            except requests.exceptions.ConnectionError as err:
+                raise DockerDaemonError("Could not reach the Docker daemon. Is it on?") from err
+        return self._image
+
+
+    @image.setter
+    def image(self, image):
+        self._image = image
+
+
+    @property
+    def install_packages(self):
+        '''
+        Only (and all) the packages we want to install (and versions). Until something removes a
+        package this is just all_packages, so call _own_install_packages before changing it.
+        '''
+        if self._install_packages is None:
+            return self.all_packages
+        return self._install_packages
+
+
+    @install_packages.setter
+    def install_packages(self, packages):
+        self._install_packages = packages
+
+
+    def _own_install_packages(self):
+        '''
+        Gives install_packages its own copy of all_packages if it doesn't have one yet, so that it
+        can be changed without touching all_packages.
+        '''
+        if self._install_packages is None:
+            self._install_packages = self.all_packages.copy()
+
+
     @property
     @abstractmethod
     def LIST_INSTALLED(self):
@@ -86,40 +220,270 @@ class SystemAnalyzer(ABC):
         '''
         ...
 
+
+    @staticmethod
+    def _split_framed(iterable, sentinel=SENTINEL):
+        '''
+        Splits output where each package's output is preceded by a line of the form
+        <sentinel><key>__, as the batched package queries frame it.
+        Returns a dictionary of lists of output lines keyed on key. Output for a key that shows up
+        more than once (e.g. a multiarch package) is put together.
+        '''
+        results = {}
+        current = None
+        for line in iterable:
+            stripped = line.strip()
+            if stripped.startswith(sentinel) and stripped.endswith('__'):
+                current = results.setdefault(stripped[len(sentinel):-2], [])
+            elif current is not None:
+                current.append(line.rstrip('\n'))
+        return results
+
+
+    @staticmethod
+    def _split_file_listing(output, count):
+        '''
+        Splits list_files_in_packages output, where each package's files are preceded by a line of
+        the form __PKG__index__, index being the package's position in the list we asked about.
+        Returns a list of lists of output lines, one per package; empty for a package that printed
+        nothing, so that no package's files can end up in another's slot.
+        '''
+        framed = SystemAnalyzer._split_framed(output.splitlines(), SystemAnalyzer.FILES_SENTINEL)
+        return [framed.get(str(idx), []) for idx in range(count)]
+
+
+    def _list_files(self, pkgs, command, parse):
+        '''
+        Does the work for list_files_in_packages: runs command on as many packages as possible per
+        SSH exec, framing each package's output with a __PKG__index__ line.
+        pkgs -- iterable of packages
+        command -- the command that lists the files a package installed; the package gets appended
+        parse -- turns the framed output (as one string) and the number of packages into a list of
+            lists of filenames
+        Returns a list of lists of filenames, one per package.
+        '''
+        pkgs = list(pkgs)
+        sentinel = SystemAnalyzer.FILES_SENTINEL
+        cmd_strings = group_strings((f"echo {sentinel}{idx}__ ; {command} {pkg}"
+                                     for idx, pkg in enumerate(pkgs)), sep=' ; ')
+        with ThreadPoolExecutor(max_workers=self.pool.size) as executor:
+            outputs = list(executor.map(self.pool.run_raw, cmd_strings))
+        return parse("\n".join(outputs), len(pkgs))
+
     @abstractmethod
     def files_changed_from_package(self, pkg):
         '''
-        Returns the list of files coming from pkg whose checksums don't match their original
-        checksums.
+        Returns the set of files coming from pkg whose checksums don't match their original
+        checksums. Called concurrently; see _query_many.
         '''
         ...
 
 
+    def _list_installed(self):
+        '''
+        Returns the lines of LIST_INSTALLED output from the target system. Uses self.package_listing
+        the first time, if someone set it; otherwise runs the command over SSH.
+        '''
+        if self.package_listing is not None:
+            listing = self.package_listing
+            # Only use it once, so that calling get_packages again picks up changes
+            self.package_listing = None
+            return listing
+        _, stdout, _ = self.ssh_client.exec_command(type(self).LIST_INSTALLED)
+        return stdout.read().decode().splitlines()
+
+
     @abstractmethod
     def get_packages(self):
         '''
         Gets all packages and versions from the target system and puts them in self.packages.
         '''
         logging.info("Getting packages...")
+        # The packages may have changed since we last looked, so forget what we knew about them
+        self._dependency_cache = {}
+        self._config_file_cache = {}
 
 
     @abstractmethod
     def get_dependencies(self, package):
         '''
-        Gets the dependencies of a particular package on the target system and returns a dictionary
-        of them.
+        Gets the dependencies of a particular package on the target system and returns a set of
+        them. Called concurrently; see _query_many.
         package -- the package to get deps for
         '''
-        logging.debug(f"Getting dependencies for {package}...")
+        logging.debug("Getting dependencies for %s...", package)
 
 
     @abstractmethod
     def get_config_files_for(self, package):
         '''
-        Returns a list of file paths to configuration files for the specified package.
+        Returns a list of file paths to configuration files for the specified package. Called
+        concurrently; see _query_many.
         package -- the package whose configurations we are interested in
         '''
-        logging.debug(f"Getting configuration files associated with {package}...")
+        logging.debug("Getting configuration files associated with %s...", package)
+
+
+    def _query_many(self, func, items):
+        '''
+        Calls func on each item concurrently, using as many workers as there are channels in the
+        pool so that the remote queries overlap. func must be safe to call from several threads at
+        once: run commands through self.pool, which hands each thread its own channel, rather than
+        through ssh_client.exec_command or shared state.
+        Returns a dictionary of results keyed on item.
+        '''
+        items = list(items)
+        with ThreadPoolExecutor(max_workers=self.pool.size) as executor:
+            return dict(zip(items, executor.map(func, items)))
+
+
+    def get_dependencies_bulk(self, packages):
+        '''
+        Gets the dependencies of many packages on the target system. Child classes may override this
+        to batch their queries; by default it calls get_dependencies once per package, concurrently.
+        packages -- iterable of packages to get deps for
+        Returns a dictionary of sets of dependencies keyed on package name.
+        '''
+        return self._query_many(self.get_dependencies, packages)
+
+
+    def get_config_files_bulk(self, packages):
+        '''
+        Gets the configuration files of many packages on the target system. Child classes may
+        override this to batch their queries; by default it calls get_config_files_for once per
+        package, concurrently.
+        packages -- iterable of packages whose configurations we are interested in
+        Returns a dictionary of sets of file paths keyed on package name.
+        '''
+        return self._query_many(self.get_config_files_for, packages)
+
+
+    def files_changed_bulk(self, packages):
+        '''
+        Finds the changed files of many packages on the target system. Child classes may override
+        this to batch their queries; by default it calls files_changed_from_package once per
+        package, concurrently.
+        packages -- iterable of packages to check
+        Returns a dictionary of sets of changed files keyed on package name.
+        '''
+        return self._query_many(self.files_changed_from_package, packages)
+
+
+    def _run_batched(self, cmds, parse, log_format=None):
+        '''
+        Runs each of cmds over the channel pool, concurrently, and parses each one's output.
+        cmds -- iterable of commands, each asking about a batch of packages
+        parse -- turns the lines one command printed into a dictionary keyed on package name
+        log_format -- if given, each package's result gets logged at debug level with it, e.g.
+            "%s > %s"
+        Returns a dictionary of all the parsed results.
+        '''
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.pool.size) as executor:
+            for stdout in executor.map(self.pool.run, cmds):
+                results.update(parse(stdout))
+        if log_format and logging.getLogger().isEnabledFor(logging.DEBUG):
+            for package, result in results.items():
+                logging.debug(log_format, package, result)
+        return results
+
+
+    def _get_arg_budget(self):
+        '''
+        Returns about how many characters of arguments a single command on the target system can
+        take: half of its ARG_MAX, leaving the rest for the environment. Checked once.
+        '''
+        if self._arg_budget is None:
+            try:
+                self._arg_budget = int(self.pool.run_raw("getconf ARG_MAX")) // 2
+            except ValueError:
+                self._arg_budget = SystemAnalyzer.DEFAULT_ARG_BUDGET
+            logging.debug(f"Batching up to {self._arg_budget} characters of arguments per command")
+        return self._arg_budget
+
+
+    @staticmethod
+    def _cached_query(cache, bulk_query, packages):
+        '''
+        Answers a per-package query from cache, only running bulk_query on the packages it hasn't
+        seen yet. Packages bulk_query says nothing about get an empty answer.
+        cache -- dictionary of earlier answers keyed on package name; gets updated
+        bulk_query -- function taking a list of packages and returning a dictionary of answers
+        packages -- iterable of packages to query
+        Returns a dictionary of answers keyed on package name.
+        '''
+        missing = [pkg for pkg in packages if pkg not in cache]
+        if missing:
+            answers = bulk_query(missing)
+            cache.update((pkg, answers.get(pkg, frozenset())) for pkg in missing)
+        return {pkg: cache[pkg] for pkg in packages}
+
+
+    def _build_image(self):
+        '''
+        Builds the Dockerfile in self.tempdir into self.image. Images are tagged with a hash of the
+        Dockerfile they came from, so if this one has been built before (in this run or an earlier
+        one) the build is skipped entirely. Otherwise the build reuses layers from the previous
+        verify image.
+        '''
+        from docker.errors import ImageNotFound # pylint: disable=import-outside-toplevel
+        with open(os.path.join(self.tempdir, 'Dockerfile'), 'rb') as dockerfile:
+            dockerfile_hash = hashlib.sha256(dockerfile.read()).hexdigest()
+        if dockerfile_hash == self._dockerfile_hash:
+            logging.debug("Dockerfile is unchanged; reusing the last image.")
+            return
+        repository = f'verify{self.op_sys}'
+        tag = f'{repository}:{dockerfile_hash[:12]}'
+        try:
+            self.image = self.docker_client.images.get(tag)
+            logging.debug(f"Reusing {tag}, built from the same Dockerfile earlier.")
+        except ImageNotFound:
+            self.image, _ = self.docker_client.images.build(tag=tag, path=self.tempdir,
+                                                            cache_from=[repository])
+            # Keep the plain name pointing at the latest build, for the next one to cache from
+            self.image.tag(repository)
+            self._remove_stale_images(repository, tag)
+        self._dockerfile_hash = dockerfile_hash
+
+
+    def _remove_stale_images(self, repository, keep):
+        '''
+        Removes the tags of every other image built by _build_image, so that each distinct
+        Dockerfile doesn't leave a whole image behind on the Docker host. Tags that Docker won't
+        remove (say, because a container still uses the image) are left for the next build.
+        repository -- the repository _build_image tags images in
+        keep -- the tag just built
+        '''
+        from docker.errors import APIError # pylint: disable=import-outside-toplevel
+        # The sidecar would hold on to the old image; a new one gets started on the next exec
+        if self._sidecar_image_id != self.image.id:
+            self._remove_sidecar()
+        stale = {old_tag for image in self.docker_client.images.list(name=repository)
+                 for old_tag in image.tags
+                 if old_tag.startswith(f'{repository}:')
+                 and old_tag not in (keep, f'{repository}:latest')}
+        for old_tag in stale:
+            try:
+                self.docker_client.images.remove(old_tag)
+                logging.debug(f"Removed stale image tag {old_tag}")
+            except APIError as err:
+                logging.debug(f"Could not remove stale image tag {old_tag}: {err}")
+
+
+    def _get_default_packages(self):
+        '''
+        Returns a dictionary of the packages installed by default in the base image, keyed on
+        package name. A base image's packages never change, so each one only gets listed once per
+        process, however many analyzers use it. Don't modify the result.
+        '''
+        if self.base_image not in _DEFAULT_PACKAGES:
+            pkg_bytestring = self.docker_client.containers.run(self.base_image,
+                                                               type(self).LIST_INSTALLED,
+                                                               remove=True)
+            # Last element is a blank line; remove it.
+            pkg_list = pkg_bytestring.decode().split('\n')[:-1]
+            _DEFAULT_PACKAGES[self.base_image] = type(self).parse_all_pkgs(pkg_list)
+        return _DEFAULT_PACKAGES[self.base_image]
 
 
     def filter_packages(self, strict_versioning=True):
@@ -133,35 +497,32 @@ class SystemAnalyzer(ABC):
         '''
         logging.info("Filtering packages...")
         assert self.all_packages, "No packages yet. Have you run get_packages?"
+        self._own_install_packages()
 
         # Optionally simplify the package list by analyzing dependencies.
         if not strict_versioning:
-            pkgs_to_remove = analyze_dependencies(self.all_packages, self.get_dependencies)
+            all_deps = self._cached_query(self._dependency_cache, self.get_dependencies_bulk,
+                                          self.all_packages)
+            pkgs_to_remove = analyze_dependencies(self.all_packages,
+                                                  lambda pkg: all_deps.get(pkg, set()))
             for pkg_name in pkgs_to_remove:
                 del self.install_packages[pkg_name]
             logging.info(f"Removing extra packages based on dependency analysis cut down "
                          f"{len(self.all_packages)} packages to {len(self.install_packages)}.")
 
         # Get default-installed packages from Docker base image we're going to use
-        pkg_bytestring = self.docker_client.containers.run(f"{self.op_sys}:{self.version}",
-                                                           type(self).LIST_INSTALLED, remove=True)
-        # Last element is a blank line; remove it.
-        pkg_list = pkg_bytestring.decode().split('\n')[:-1]
-        default_packages = type(self).parse_all_pkgs(pkg_list)
-
-        # Delete default packages from what we'll install
-        for pkg_name, pkg_ver in default_packages.items():
-            try:
-                existing_version = self.install_packages[pkg_name]
-                # If we don't care about version mismatch (or there is none)
-                if not strict_versioning or existing_version == pkg_ver:
-                    del self.install_packages[pkg_name]
-                    if not strict_versioning:
-                        # Record mismatch
-                        self.unversion_packages[pkg_name] = pkg_ver
-            except KeyError:
-                # Package not slated to be installed anyway
-                pass
+        default_packages = self._get_default_packages()
+
+        # Delete default packages from what we'll install. Only packages slated to be installed
+        # matter, so intersect the names up front.
+        for pkg_name in self.install_packages.keys() & default_packages.keys():
+            pkg_ver = default_packages[pkg_name]
+            # If we don't care about version mismatch (or there is none)
+            if not strict_versioning or self.install_packages[pkg_name] == pkg_ver:
+                del self.install_packages[pkg_name]
+                if not strict_versioning:
+                    # Record mismatch
+                    self.unversion_packages[pkg_name] = pkg_ver
 
         logging.info(f"Removing defaults cut down {len(self.all_packages)} packages to "
                      f"{len(self.install_packages)}.")
@@ -183,32 +544,15 @@ class SystemAnalyzer(ABC):
         logging.info(f"Verifying packages in {mode.name} mode...")
         self.dockerize(self.tempdir, verbose=False)
         # Now that we have a Dockerfile, build and check the packages are there
-        self.image, _ = self.docker_client.images.build(tag=f'verify{self.op_sys}',
-                                                        path=self.tempdir)
+        self._build_image()
 
-        try:
-            container = self.docker_client.containers.run(image=self.image.id,
-                                                          command=type(self).LIST_INSTALLED,
-                                                          detach=True)
-            # Block until the command's done, then check its output.
-            container.wait()
-            output = container.logs()
-        finally:
-            # Clean up after yourself.
-            container.remove(force=True)
-
-        # Evaluate packages on the system.
-        output = output.decode()
-        logging.debug(output)
-        there = 0
-        total = 0
-        missing = []
-        for package in self.install_packages:
-            if package in output:
-                there += 1
-            else:
-                missing.append(package)
-            total += 1
+        # Evaluate packages on the system. Compare against parsed names rather than searching the
+        # raw output, which is slow and lets e.g. libssl match libssl-dev.
+        installed = type(self).parse_all_pkgs(self._stream_from_sidecar(type(self).LIST_INSTALLED))
+        logging.debug("Installed: %s", installed)
+        missing = [package for package in self.install_packages if package not in installed]
+        total = len(self.install_packages)
+        there = total - len(missing)
 
         # Handle missing code with fallback strat.
         if missing:
@@ -233,44 +577,63 @@ class SystemAnalyzer(ABC):
         Returns True if the fallback method was sufficient; False otherwise. (Dry mode, thus, is
         always false, since it never does anything.)
         '''
+        missing = self._start_fallback(missing, mode)
+        if missing is None:
+            return False
+
+        self.dockerize(self.tempdir, verbose=False)
+        self._build_image()
+        pkgs_after_fallback = self.parse_all_pkgs(
+            self._stream_from_sidecar(type(self).LIST_INSTALLED))
+        logging.debug("Installed: %s", pkgs_after_fallback)
+        return self._finish_fallback(missing, pkgs_after_fallback)
+
+
+    def _start_fallback(self, missing, mode):
+        '''
+        Does the first part of _run_fallback, which doesn't depend on the system: takes the missing
+        packages out of install_packages (and, in delete mode, unversion_packages), and in unversion
+        mode marks them to be installed without a version.
+        Returns the missing packages as a set, or None in dry mode, where there's nothing to do.
+        '''
         logging.info(f"Now running verification fallback in {mode.name} mode...")
 
         if mode == self.Mode.dry:
             logging.info("Dry mode does not take any fallback actions for missing packages.")
-            return False
+            return None
+
+        # Build the smaller lists in one go rather than deleting packages one at a time; this also
+        # gives install_packages its own dictionary
+        missing = set(missing)
+        self.install_packages = {name: ver for name, ver in self.install_packages.items()
+                                 if name not in missing}
 
         if mode == self.Mode.delete:
             logging.info(f"Now removing bad packages...")
-            for pkg_name in missing:
-                del self.install_packages[pkg_name]
+            self.unversion_packages = {name: ver for name, ver in self.unversion_packages.items()
+                                       if name not in missing}
 
         if mode == self.Mode.unversion:
             logging.info(f"Now removing version numbers from bad packages...")
-            for pkg_name in missing:
-                del self.install_packages[pkg_name]
-                self.unversion_packages[pkg_name] = False
+            self.unversion_packages.update(dict.fromkeys(missing, False))
 
         logging.info(f"Verifying packages after employing fallback...")
-        self.dockerize(self.tempdir, verbose=False)
-        self.image, _ = self.docker_client.images.build(tag=f'verify{self.op_sys}',
-                                                        path=self.tempdir)
-        con = self.docker_client.containers.run(image=self.image.id,
-                                                command=type(self).LIST_INSTALLED,
-                                                remove=True)
-        output = con.decode().split('\n')[:-1]
-        pkgs_after_fallback = self.parse_all_pkgs(output)
-        logging.debug(f"Installed: {pkgs_after_fallback}")
-
-        # Check which packages were able to be recovered by fallback
-        recovered = set()
-        still_gone = set()
-        for package in missing:
-            if package in pkgs_after_fallback:
-                # In unversion mode, save the version number we found
-                self.unversion_packages[package] = pkgs_after_fallback[package]
-                recovered.add(package)
-            else:
-                still_gone.add(package)
+        return missing
+
+
+    def _finish_fallback(self, missing, pkgs_after_fallback):
+        '''
+        Does the last part of _run_fallback: saves the versions found for the missing packages that
+        were recovered, and reports on the rest.
+        missing -- set of packages fallback was run for
+        pkgs_after_fallback -- dictionary of the versions the fallback install got, keyed on package
+        Returns True if everything was recovered; False otherwise.
+        '''
+        recovered = missing & pkgs_after_fallback.keys()
+        still_gone = missing - recovered
+        # In unversion mode, save the version numbers we found
+        self.unversion_packages.update((package, pkgs_after_fallback[package])
+                                       for package in recovered)
         logging.info(f"Recovered these packages via fallback strategy ({len(recovered)}): "
                      f"{recovered}")
         logging.info(f"Still missing ({len(still_gone)}): {still_gone}")
@@ -279,107 +642,17 @@ class SystemAnalyzer(ABC):
         return len(still_gone) == 0
 
 
-    def get_hash_from_container(self, filepath, is_directory=False):
-        '''
-        Given a filepath, returns a checksum of the indicated file.
-        You may also pass a space-separated list of files.
-        If your path is a directory, it must end in a slash. I don't check for this but you gotta.
-        If is_directory is True, go into subdirectories, else assume it is a single file.
-        Target docker image must have cksum available for use.
-        Must be called after verify_packages, as it relies on the container having
-        already been built and its packages installed.
-        '''
-        if not filepath:
-            logging.warning("Please pass a filepath.")
-            return None
-        logging.debug(f"Hashing filepath {filepath} from the container...")
-
-        try:
-            if is_directory:
-                container = self.docker_client.containers.run(image=self.image.id,
-                                                              command=f"find {filepath} -type f "
-                                                                      f"-exec cksum '{{}}' \\;",
-                                                              detach=True)
-            else:
-                container = self.docker_client.containers.run(image=self.image.id,
-                                                              command=f"cksum {filepath}",
-                                                              detach=True)
-            container.wait()
-            crc = None
-            output = container.logs().decode()
-            # Extract hashes and sizes from output.
-            lines = output.split('\n')
-            for line in lines:
-                if line == "":
-                    continue
-                if 'No such file' in line:
-                    # Couldn't find the file. This is expected to happen sometimes; just keep going.
-                    logging.debug(f"From container: {line}")
-                    continue
-                if 'Permission denied' in line:
-                    logging.debug(f"From container: {line}")
-                    continue
-                try:
-                    crc, size, file = line.split()
-                    self.container_hashes[file] = {'hash': crc, 'size': size}
-                except ValueError:
-                    logging.error(f"Unexpected number of values returned from line: {line.split()}")
-                    raise
-            if is_directory:
-                # In this case, the returned hash would just be the last thing hashed; not
-                # meaningful, so don't return it.
-                return None
-            return crc
-        finally:
-            container.remove(force=True)
-
-
-    def get_hash_from_vm(self, filepath, is_directory=False):
-        '''
-        Given a filepath, returns a checksum of the indicated file from a VM.
-        You may also pass a space-separated list of files.
-        If your path is a directory, it must end in a slash. I don't check for this but you gotta.
-        If is_directory is True, go into subdirectories, else assume it is a single file.
-        '''
-        if not filepath:
-            logging.warning("Please pass a filepath.")
-            return None
-        logging.debug(f"Hashing file {filepath} from the VM...")
-        if is_directory:
-            _, stdout, _ = self.ssh_client.exec_command(f"find {filepath} -type f "
-                                                        f"-exec cksum '{{}}' \\;")
-        else:
-            _, stdout, _ = self.ssh_client.exec_command(f'cksum {filepath}')
-        crc = None
-        for line in stdout:
-            if line == "":
-                continue
-            if 'No such file' in line:
-                # Couldn't find the file. This is expected to happen sometimes; just keep going.
-                continue
-            try:
-                crc, size, file = line.split()
-                self.vm_hashes[file] = {'hash': crc, 'size': size}
-            except ValueError:
-                logging.error(f"Unexpected number of values returned from line: {line.split()}")
-                raise
-        if is_directory:
-            # In this case, the returned hash would just be the last thing hashed; not meaningful,
-            # so don't return it.
-            return None
-        return crc
-
     def get_file_pkg_assocs(self):
         '''
         Populates self.packages_files with the pairings from each package to the
-        files that were installed as part of it.
+        (frozen) set of files that were installed as part of it.
         Returns nothing.
         '''
         logging.info("Gathering file-package associations...")
 
         files = self.list_files_in_packages(self.all_packages)
         for i, pkg in enumerate(self.all_packages):
-            self.packages_files[pkg] = files[i]
+            self.packages_files[pkg] = frozenset(files[i])
 
     def analyze_files(self, allowlist=None, blocklist=None):
         '''
@@ -406,28 +679,47 @@ class SystemAnalyzer(ABC):
                                   f"{diff_tuple[0]}")
             self.file_logger.info(f"Shared ({len(diff_tuple[1])}):\n{diff_tuple[1]}")
             self.file_logger.info(f"Just VM ({len(diff_tuple[2])}):\n{diff_tuple[2]}")
-            # Now cksum the shared ones
+            # Files of different sizes must differ, and files whose size and mtime both match almost
+            # certainly don't, so only cksum the shared files stat can't settle
             modified_files = set()
-            for folder_str in group_strings(list(diff_tuple[1])):
-                self.get_hash_from_container(folder_str, is_directory=False)
-                self.get_hash_from_vm(folder_str, is_directory=False)
+            to_hash = set()
+            vm_stats, container_stats = self.stat_files_on_both(diff_tuple[1])
             for file in diff_tuple[1]:
-                container_h = self.container_hashes[file]["hash"]
-                vm_h = self.vm_hashes[file]["hash"]
-                if container_h != vm_h:
+                vm_stat = vm_stats.get(file)
+                container_stat = container_stats.get(file)
+                if vm_stat is None or container_stat is None:
+                    to_hash.add(file)
+                elif vm_stat[0] != container_stat[0]:
+                    modified_files.add(file)
+                elif vm_stat[1] != container_stat[1]:
+                    to_hash.add(file)
+            logging.debug(f"Hashing {len(to_hash)} of {len(diff_tuple[1])} shared files")
+            self.hash_files_on_both(to_hash)
+            unhashed = set()
+            for file in to_hash:
+                container_h = self.container_hashes.get(file)
+                vm_h = self.vm_hashes.get(file)
+                if container_h is None or vm_h is None:
+                    # Couldn't read it on at least one side, so there's nothing to compare
+                    unhashed.add(file)
+                elif container_h.hash != vm_h.hash:
                     modified_files.add(file)
+            if unhashed:
+                logging.debug("Could not hash these files in %s on both systems: %s", folder,
+                              unhashed)
             logging.info(f"In {folder}, {len(modified_files)} out of {len(diff_tuple[1])} files "
                          f"found on both systems were different.")
-            logging.debug(f"These files in {folder} were different: {modified_files}")
+            logging.debug("These files in %s were different: %s", folder, modified_files)
             self.file_logger.info(f"Same name, but different cksum "
                                   f"({len(modified_files)}):\n{modified_files}")
             analysis_results[folder] = self.examine_files_and_packages(blocklist, diff_tuple[0],
                                                                        modified_files,
                                                                        diff_tuple[2])
 
-        diff_json = open("file_difference_analysis.json", "w+")
-        diff_json.write(json.dumps(analysis_results, indent=2))
-        diff_json.close()
+        # Stream compact JSON straight to the file; indenting hundreds of thousands of paths doubles
+        # the size and the time it takes to write.
+        with open("file_difference_analysis.json", "w") as diff_json:
+            json.dump(analysis_results, diff_json, separators=(',', ':'))
 
     def examine_files_and_packages(self, blocklist, just_cont, shared, just_vm):
         '''
@@ -456,57 +748,49 @@ class SystemAnalyzer(ABC):
             self.get_file_pkg_assocs()
             logging.info("...done!")
 
-        try:
-            container = self.docker_client.containers.run(image=self.image.id,
-                                                          command=type(self).LIST_INSTALLED,
-                                                          detach=True)
-            container.wait()
-            output = container.logs().decode()
-        finally:
-            container.remove(force=True)
-
-        # Last element is a blank line; remove it.
-        pkg_list = output.split('\n')[:-1]
-        cont_pkgs = type(self).parse_all_pkgs(pkg_list)
+        cont_pkgs = type(self).parse_all_pkgs(self._stream_from_sidecar(type(self).LIST_INSTALLED))
+
+        # Each file is in at most one of the three sets; remember which for the counts below.
+        just_vm_state, just_cont_state, shared_state = 0, 1, 2
+        state = dict.fromkeys(just_vm, just_vm_state)
+        state.update(dict.fromkeys(just_cont, just_cont_state))
+        state.update(dict.fromkeys(shared, shared_state))
 
+        # Packages whose versions differ need to be checked on the VM; do that concurrently. Only
+        # files on the VM consult the check, so skip packages that have none.
+        on_vm = just_vm | shared
+        mismatched = [pkg for pkg, ver in self.all_packages.items()
+                      if cont_pkgs.get(pkg) != ver
+                      and not on_vm.isdisjoint(self.packages_files[pkg])]
+        changed_by_pkg = self.files_changed_bulk(mismatched) if mismatched else {}
+
+        # Classify each package's files with set operations rather than a Python loop per file.
+        # Files in none of the three sets are the same on both vm and container, so are ignored.
         for pkg in self.all_packages:
             pkg_files = self.packages_files[pkg]
+            seen |= pkg_files
+            deleted_files |= pkg_files & just_cont
             if pkg in cont_pkgs and self.all_packages[pkg] == cont_pkgs[pkg]:
-                for file in pkg_files:
-                    seen.add(file)
-                    if file in just_vm:
-                        added_files.add(file)
-                    elif file in just_cont:
-                        deleted_files.add(file)
-                    elif file in shared:
-                        modified_files.add(file)
-                    else:
-                        # Ignore file, it is the same on both vm and container
-                        ...
+                added_files |= pkg_files & just_vm
+                modified_files |= pkg_files & shared
             else:
-                changed_files = self.files_changed_from_package(pkg)
-                for file in pkg_files:
-                    seen.add(file)
-                    if file in just_vm:
-                        if file in changed_files:
-                            added_files.add(file)
-                        else:
-                            ver_mismatch_files.add(file)
-                    elif file in just_cont:
-                        deleted_files.add(file)
-                    elif file in shared:
-                        if file in changed_files:
-                            modified_files.add(file)
-                        else:
-                            ver_mismatch_files.add(file)
-                    else:
-                        # Ignore file, it is the same on both vm and container
-                        ...
-        different_files_not_from_pkgs = (just_cont - seen) | (just_vm - seen) | (shared - seen)
+                # If the versions differ, only files the VM says changed were actually modified;
+                # the rest may just come from the other version.
+                changed_files = changed_by_pkg.get(pkg, frozenset())
+                pkg_just_vm = pkg_files & just_vm
+                pkg_shared = pkg_files & shared
+                added_files |= pkg_just_vm & changed_files
+                modified_files |= pkg_shared & changed_files
+                ver_mismatch_files |= (pkg_just_vm | pkg_shared) - changed_files
+        # state is keyed on every file in the three sets, so this is their union minus seen. Count
+        # where each leftover came from rather than building a difference per set.
+        different_files_not_from_pkgs = state.keys() - seen
+        not_from_pkgs = Counter(state[file] for file in different_files_not_from_pkgs)
         logging.info("Number of files on only the container not from packages: "
-                     f"{len(just_cont - seen)}")
-        logging.info(f"Number of files on only the vm not from packages: {len(just_vm - seen)}")
-        logging.info(f"Number of files on both, not from packages: {len(shared - seen)}")
+                     f"{not_from_pkgs[just_cont_state]}")
+        logging.info("Number of files on only the vm not from packages: "
+                     f"{not_from_pkgs[just_vm_state]}")
+        logging.info(f"Number of files on both, not from packages: {not_from_pkgs[shared_state]}")
         logging.info("Total number of different files not from packages: "
                      f"{len(different_files_not_from_pkgs)}")
 
@@ -521,70 +805,6 @@ class SystemAnalyzer(ABC):
         return data_dict
 
 
-    def compare_names(self, location='/', blocklist=None):
-        '''
-        Compares names of the entire system, excluding anything in the (absolute) paths in the
-        blocklist.
-        Blocklist paths may go to folders, in which case they must be formatted /path/folder/*
-        Otherwise, they may go to files, in which case they must be formatted /path/file
-        Returns a tuple of filenames only on the container, filenames on both, and filenames only on
-        the VM.
-        '''
-        docker_filenames = set()
-        vm_filenames = set()
-
-        # Strip trailing slashes from location
-        command = "find . -type f "
-        if location == '/':
-            if blocklist:
-                for place in blocklist:
-                    command += f"! -path '.{place}' "
-        else:
-            location = location.rstrip('/')
-            regex = re.compile(location.replace('/', r'\/') + r"\/*")
-
-            if blocklist:
-                for place in blocklist:
-                    if place.startswith(location):
-                        trimmed = regex.sub('./', place)
-                        command += f"! -path '{trimmed}' "
-        logging.debug(f"Running command: {'cd ' + location + ' && ' + command}")
-
-        # Analyze VM
-        _, vm_out, _ = self.ssh_client.exec_command('cd ' + location + ' && ' + command)
-        if location == '/':
-            for line in vm_out:
-                vm_filenames.add(line.strip()[1:])
-        else:
-            for line in vm_out:
-                vm_filenames.add(line.strip().replace('.', location, 1))
-
-        try:
-            container = self.docker_client.containers.run(image=self.image.id,
-                                                          command="tail -f dev/null",
-                                                          detach=True)
-            _, (byteout, _) = container.exec_run(cmd=command, workdir=location, demux=True)
-
-            if byteout:
-                con_out = byteout.decode().split('\n')[:-1]
-                if location == '/':
-                    for line in con_out:
-                        if ": Permission denied" not in line:
-                            docker_filenames.add(line[1:])
-                else:
-                    for line in con_out:
-                        # TODO: selinux seems to break things; ignoring for now. See #60
-                        if ": Permission denied" not in line:
-                            docker_filenames.add(line.replace('.', location, 1))
-            logging.debug(f"The total number of files in the VM is {len(vm_filenames)}")
-            logging.debug(f"The total number of files in the container is {len(docker_filenames)}")
-            return (docker_filenames - vm_filenames,
-                    vm_filenames & docker_filenames,
-                    vm_filenames - docker_filenames)
-        finally:
-            container.remove(force=True)
-
-
     def get_config_differences(self):
         '''
         Compares the checksums of all config files on the system.
@@ -603,57 +823,39 @@ class SystemAnalyzer(ABC):
 
         # Populate full set of all config files on the system
         configs = set()
-        for pkg in self.all_packages:
-            configs |= self.get_config_files_for(pkg)
+        for pkg_configs in self._cached_query(self._config_file_cache, self.get_config_files_bulk,
+                                              self.all_packages).values():
+            configs |= pkg_configs
 
         # Hash and save all files in configs
-        for file_group in group_strings(list(configs)):
-            self.get_hash_from_vm(file_group)
-            self.get_hash_from_container(file_group)
-
-        # Determine what got hashed
-        for config in configs:
-            vm_hash = None
-            container_hash = None
-            try:
-                vm_hash = self.vm_hashes[config]
-                # The file is on the VM
-                self.vm_configs.add(config)
-            except KeyError:
-                pass
-            try:
-                container_hash = self.container_hashes[config]
-                # The file is on the container
-                self.container_configs.add(config)
-            except KeyError:
-                pass
-            # If we got both hashes, compare them
-            if vm_hash and container_hash and vm_hash != container_hash:
-                self.diff_configs.add(config)
-
-        # Log what we've found
+        self.hash_files_on_both(configs)
+
+        # Determine what got hashed on each side, and compare the ones hashed on both
+        self.vm_configs = configs & self.vm_hashes.keys()
+        self.container_configs = configs & self.container_hashes.keys()
+        self.diff_configs = {config for config in self.vm_configs & self.container_configs
+                             if self.vm_hashes[config] != self.container_hashes[config]}
+
+        # Log what we've found. Each of these goes to both logs, so only compute them once.
+        identical = self.vm_configs & self.container_configs - self.diff_configs
+        missing_on_vm = self.container_configs - self.vm_configs
+        missing_on_container = self.vm_configs - self.container_configs
         logging.info(f"Number of configs on vm: {len(self.vm_configs)}")
         logging.info(f"Number of configs on container: {len(self.container_configs)}")
-        logging.info(f"Number of identical config files: "
-                     f"{len(self.vm_configs & self.container_configs - self.diff_configs)}")
+        logging.info(f"Number of identical config files: {len(identical)}")
         logging.info(f"Config differences ({len(self.diff_configs)}) are {self.diff_configs}")
-        logging.info(f"Configs missing on vm ({len(self.container_configs - self.vm_configs)}) "
-                     f"are {self.container_configs - self.vm_configs}")
-        logging.info(f"Configs missing on container "
-                     f"({len(self.vm_configs - self.container_configs)}) are "
-                     f"{self.vm_configs - self.container_configs}")
+        logging.info(f"Configs missing on vm ({len(missing_on_vm)}) are {missing_on_vm}")
+        logging.info(f"Configs missing on container ({len(missing_on_container)}) are "
+                     f"{missing_on_container}")
         self.file_logger.info(f"Number of configs on vm: {len(self.vm_configs)}")
         self.file_logger.info(f"Number of configs on container: {len(self.container_configs)}")
         self.file_logger.info(f"Number of identical configs on both vm and container: "
-                              f"{len(self.vm_configs & self.container_configs - self.diff_configs)}")
+                              f"{len(identical)}")
         self.file_logger.info(f"Config differences ({len(self.diff_configs)}):\n"
                               f"{self.diff_configs}")
-        self.file_logger.info(f"Configs missing on vm "
-                              f"({len(self.container_configs - self.vm_configs)}):\n"
-                              f"{self.container_configs - self.vm_configs}")
-        self.file_logger.info(f"Configs missing on container "
-                              f"({len(self.vm_configs - self.container_configs)}):\n"
-                              f"{self.vm_configs - self.container_configs}")
+        self.file_logger.info(f"Configs missing on vm ({len(missing_on_vm)}):\n{missing_on_vm}")
+        self.file_logger.info(f"Configs missing on container ({len(missing_on_container)}):\n"
+                              f"{missing_on_container}")
 
 
     @abstractmethod
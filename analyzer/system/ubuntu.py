@@ -2,15 +2,15 @@
 UbuntuAnalyzer inherits from SystemAnalyzer and contains methods to analyze Ubuntu/apt systems.
 '''
 
+# These imports are the same as centos.py's; that isn't duplicate code worth sharing
+# pylint: disable=duplicate-code
 import logging
 import os
 import re
 
-import docker
-import requests.exceptions
-
 from .system import SystemAnalyzer
 from ..utils import group_strings
+# pylint: enable=duplicate-code
 
 
 
@@ -19,6 +19,20 @@ class UbuntuAnalyzer(SystemAnalyzer):
     Inherits from SystemAnalyzer to provide functions for analyzing Ubuntu/apt style systems.
     '''
     LIST_INSTALLED = 'apt list --installed'
+    # apt list chatter that comes before the package lines
+    SKIP_PREFIXES = ('WARNING:', 'Listing')
+    # What apt-get install says about packages or versions it couldn't find, or any other error
+    INSTALL_ERROR_PATTERN = re.compile("E: Unable to locate package (?P<pkg>.*)\n"
+                                       "|' for '(?P<ver>.*)' was not found\n"
+                                       "|(?P<err>E: )")
+    # Reports what apt-get install would do without downloading or installing anything; missing
+    # packages and versions give the same errors as a real install
+    SIMULATE_INSTALL = 'apt-get install --simulate --allow-downgrades'
+    # apt-cache depends, leaving out the relations we don't look at so there's less to send back
+    DEPENDS = ('apt-cache depends --no-recommends --no-suggests --no-conflicts --no-breaks '
+               '--no-replaces --no-enhances')
+    # A Depends or PreDepends line of apt-cache depends output
+    DEPENDS_PATTERN = re.compile(r'Depends:\s*(.+)$')
 
 
     @staticmethod
@@ -30,9 +44,10 @@ class UbuntuAnalyzer(SystemAnalyzer):
         # Assumes line comes in as something like
         # 'accountsservice/bionic,now 0.6.45-1ubuntu1 amd64 [installed,automatic]'
         clean_line = line.strip() # Trim whitespace
-        name = clean_line.split('/')[0]
-        ver = clean_line.split('now ')[1] # 0.6.45-1ubuntu1 amd64 [installed,automatic]
-        ver = ver.split(' ')[0] # 0.6.45-1ubuntu1
+        # Partition rather than split; each one only cuts the line once
+        name, _, rest = clean_line.partition('/')
+        _, _, ver = rest.partition('now ') # 0.6.45-1ubuntu1 amd64 [installed,automatic]
+        ver, _, _ = ver.partition(' ') # 0.6.45-1ubuntu1
         return (name, ver)
 
 
@@ -42,17 +57,121 @@ class UbuntuAnalyzer(SystemAnalyzer):
         Parses an iterable of apt list --installed style output.
         Returns a dictionary of package versions keyed on package name.
         '''
-        packages = {}
+        # Let dict build itself from the parsed pairs rather than assigning them one by one
+        return dict(UbuntuAnalyzer.parse_pkg_line(line) for line in iterable
+                    if line and not line.startswith(UbuntuAnalyzer.SKIP_PREFIXES))
+
+    @staticmethod
+    def parse_conffiles(iterable):
+        '''
+        Parses dpkg-query output where each package's ${Conffiles} field is preceded by a line of
+        the form __SEP__pkg__. Conffiles dpkg has marked obsolete are left out.
+        Returns a dictionary of sets of configuration file paths keyed on package name.
+        '''
+        results = {}
+        # Multiarch packages show up once per architecture; _split_framed puts them together
+        for package, lines in UbuntuAnalyzer._split_framed(iterable).items():
+            # Each conffile line looks like ' /etc/bash.bashrc 89269e1298235f1b12b4c16e4065ad0d'
+            results[package] = {fields[0] for fields in map(str.split, lines)
+                                if fields and 'obsolete' not in fields[2:]}
+        return results
+
+    @staticmethod
+    def parse_file_listing(output, count):
+        '''
+        Parses dpkg-query -L output where each package's files are preceded by a line of the form
+        __PKG__index__, index being the package's position in the list we asked about. Directories
+        get listed alongside the files in them.
+        output -- the raw output, as one string
+        count -- the number of packages we asked about
+        Returns a list of lists of filenames, one per package, leaving out directories that have
+        anything else from the package in them.
+        '''
+        files = []
+        for lines in UbuntuAnalyzer._split_file_listing(output, count):
+            # Paths all start with /; anything else is a message (not installed, no files,
+            # diversions) and gets skipped. /. is the package's root and isn't a file.
+            paths = [line for line in map(str.strip, lines)
+                     if line.startswith('/') and line != '/.']
+            # Directories that have something else from the package in them, so we can drop them
+            parents = {path.rsplit('/', 1)[0] for path in paths if path.count('/') >= 2}
+            files.append([path for path in paths if path not in parents])
+        return files
+
+    @staticmethod
+    def parse_depends(iterable):
+        '''
+        Parses apt-cache depends output for several packages, where each package's name is on a
+        line of its own and its dependencies are indented underneath.
+        Returns a dictionary of sets of dependencies keyed on package name.
+        '''
+        results = {}
+        current = None
         for line in iterable:
-            if line == '':
+            if not line.strip():
                 continue
-            if re.match(r'WARNING:', line):
-                continue
-            if re.match(r'Listing', line):
+            if not line[0].isspace():
+                current = line.strip()
+                results.setdefault(current, set())
+            elif current is not None:
+                match = UbuntuAnalyzer.DEPENDS_PATTERN.search(line)
+                if match:
+                    results[current].add(match.group(1).strip())
+        return results
+
+    @staticmethod
+    def parse_install_output(output):
+        '''
+        Scans apt-get install output for errors in a single pass.
+        Returns a tuple of the packages it couldn't find, the packages it couldn't find the
+        requested versions of, and whether it reported any error at all.
+        '''
+        missing_pkgs = []
+        missing_vers = []
+        failed = False
+        for match in UbuntuAnalyzer.INSTALL_ERROR_PATTERN.finditer(output):
+            if match.lastgroup == 'pkg':
+                missing_pkgs.append(match.group('pkg'))
+            elif match.lastgroup == 'ver':
+                missing_vers.append(match.group('ver'))
+            failed = True
+        return missing_pkgs, missing_vers, failed
+
+    @staticmethod
+    def parse_policy(iterable):
+        '''
+        Parses apt-cache policy output for several packages, where each package's name is on a
+        line of its own (ending in a colon) and its candidate version is indented underneath.
+        Returns a dictionary of candidate versions keyed on package name, leaving out packages with
+        no candidate.
+        '''
+        results = {}
+        current = None
+        for line in iterable:
+            if line and not line[0].isspace():
+                current = line.strip()[:-1] if line.strip().endswith(':') else None
                 continue
-            pkg_name, pkg_ver = UbuntuAnalyzer.parse_pkg_line(line)
-            packages[pkg_name] = pkg_ver
-        return packages
+            field, _, value = line.strip().partition(': ')
+            if current is not None and field == 'Candidate' and value != '(none)':
+                results[current] = value
+        return results
+
+    @staticmethod
+    def parse_verify(iterable):
+        '''
+        Parses dpkg --verify output where each package's output is preceded by a line of the form
+        __SEP__pkg__.
+        Returns a dictionary of sets of files whose checksums don't match, keyed on package name.
+        '''
+        results = {}
+        for package, lines in UbuntuAnalyzer._split_framed(iterable).items():
+            if any("is not installed" in line or "contains no files" in line for line in lines):
+                results[package] = set()
+            else:
+                # Only conffiles have an attribute column before the path
+                results[package] = {fields[-1] for fields in map(str.split, lines)
+                                    if fields and '5' in fields[0]}
+        return results
 
     def list_files_in_packages(self, pkgs):
         '''
@@ -60,57 +179,21 @@ class UbuntuAnalyzer(SystemAnalyzer):
         Gets the list of files installed as part of each package.
         Returns a list of lists of filenames.
         '''
-        files = [[]] * len(pkgs)
-        i = -1
-        pkg_strings = group_strings(pkgs)
-
-        temp = []
-        for pkg_string in pkg_strings:
-            _, stdout, _ = self.ssh_client.exec_command(f"dpkg-query -L {pkg_string}")
-            for line in stdout:
-                line = line.strip()
-                if re.search("is not installed", line):
-                    # Do nothing
-                    ...
-                elif re.search("contains no files", line):
-                    # Do nothing
-                    ...
-                elif line == '':
-                    # Do nothing
-                    ...
-                elif line == '/.':
-                    files[i] = temp
-                    temp = []
-                    i += 1
-                else:
-                    temp.append(line)
-        files[i] = temp
-
-        # Remove directories from file list
-        for file_list in files:
-            for file in file_list:
-                split = file.split('/')
-                if len(split) >= 3:
-                    try:
-                        file_list.remove('/'.join(split[:-1]))
-                    except ValueError:
-                        pass
-        return files
+        return self._list_files(pkgs, 'dpkg-query -L', UbuntuAnalyzer.parse_file_listing)
 
     def files_changed_from_package(self, pkg):
         '''
-        Returns the list of files coming from pkg whose checksums don't match their original
+        Returns the set of files coming from pkg whose checksums don't match their original
         checksums.
         '''
-        files = []
-        _, stdout, _ = self.ssh_client.exec_command(f"dpkg --verify {pkg}")
+        files = set()
+        stdout = self.pool.run(f"dpkg --verify {pkg}")
         for line in stdout:
-            if re.search("is not installed", line):
-                return []
-            if re.search("contains no files", line):
-                return []
+            if "is not installed" in line or "contains no files" in line:
+                return set()
             if '5' in line.split()[0]:
-                files.append(line.split()[2].strip())
+                # Only conffiles have an attribute column before the path
+                files.add(line.split()[-1])
         return files
 
 
@@ -119,11 +202,9 @@ class UbuntuAnalyzer(SystemAnalyzer):
         Gets all packages and versions from the target system.
         '''
         super().get_packages()
-        _, stdout, _ = self.ssh_client.exec_command(UbuntuAnalyzer.LIST_INSTALLED)
-        self.all_packages = UbuntuAnalyzer.parse_all_pkgs(stdout)
-        # Note that this is a shallow copy; if you add more info to the dictionaries later on,
-        # you'll have to change this.
-        self.install_packages = self.all_packages.copy()
+        self.all_packages = UbuntuAnalyzer.parse_all_pkgs(self._list_installed())
+        # Share all_packages until something actually removes a package from the install list
+        self.install_packages = None
         logging.debug(self.all_packages)
 
 
@@ -133,50 +214,122 @@ class UbuntuAnalyzer(SystemAnalyzer):
         package -- the package to get deps for
         '''
         super().get_dependencies(package)
-        _, stdout, _ = self.ssh_client.exec_command(f"apt-cache depends {package}")
-        deps = {line.split("Depends:")[1].strip() for line in stdout if "Depends:" in line}
-        logging.debug(f"{package} > {deps}")
+        stdout = self.pool.run(f"{UbuntuAnalyzer.DEPENDS} {package}")
+        matches = map(UbuntuAnalyzer.DEPENDS_PATTERN.search, stdout)
+        deps = {match.group(1).strip() for match in matches if match}
+        logging.debug("%s > %s", package, deps)
         return deps
 
 
+    def get_dependencies_bulk(self, packages):
+        '''
+        Gets the dependencies of many packages on the target system using apt-cache, asking about as
+        many packages as possible in each command.
+        packages -- iterable of packages to get deps for
+        Returns a dictionary of sets of dependencies keyed on package name.
+        '''
+        logging.debug(f"Getting dependencies for {len(packages)} packages...")
+        cmds = [f"{UbuntuAnalyzer.DEPENDS} {pkg_string}"
+                for pkg_string in group_strings(packages, self._get_arg_budget())]
+        return self._run_batched(cmds, UbuntuAnalyzer.parse_depends, "%s > %s")
+
+
+    def files_changed_bulk(self, packages):
+        '''
+        Finds the changed files of many packages on the target system, running dpkg --verify on as
+        many packages as possible per command.
+        packages -- iterable of packages to check
+        Returns a dictionary of sets of changed files keyed on package name.
+        '''
+        cmds = group_strings((f"echo {UbuntuAnalyzer.SENTINEL}{pkg}__ ; dpkg --verify {pkg}"
+                              for pkg in packages), sep=' ; ')
+        return self._run_batched(cmds, UbuntuAnalyzer.parse_verify)
+
+
     def get_config_files_for(self, package):
         '''
         Returns a list of file paths to configuration files for the specified package.
         package -- the package whose configurations we are interested in
         '''
         super().get_config_files_for(package)
-        _, stdout, _ = self.ssh_client.exec_command(f"cat /var/lib/dpkg/info/{package}.conffiles")
-        configs = {line.strip() for line in stdout}
-        logging.debug(f"{package} has the following config files: {configs}")
+        stdout = self.pool.run(f"cat /var/lib/dpkg/info/{package}.conffiles")
+        configs = set(map(str.strip, stdout))
+        configs.discard('')
+        logging.debug("%s has the following config files: %s", package, configs)
         return configs
 
 
+    def get_config_files_bulk(self, packages):
+        '''
+        Gets the configuration files of many packages on the target system in as few SSH execs as
+        possible.
+        packages -- iterable of packages whose configurations we are interested in
+        Returns a dictionary of sets of file paths keyed on package name.
+        '''
+        logging.debug(f"Getting configuration files associated with {len(packages)} packages...")
+        query = f"dpkg-query -W -f='{UbuntuAnalyzer.SENTINEL}${{Package}}__\\n${{Conffiles}}\\n' "
+        cmds = [query + pkg_string
+                for pkg_string in group_strings(packages, self._get_arg_budget())]
+        # Each package is asked about in only one batch, so its architectures all come back together
+        return self._run_batched(cmds, UbuntuAnalyzer.parse_conffiles,
+                                 "%s has the following config files: %s")
+
+
     def _assemble_packages(self):
         '''
         Assembles all packages and versions (if applicable) into strings for the installer, and
         returns the strings in a tuple of an install line for packages with matched versions, a
         comment of unversioned packages, and an install line of packages with substitute
-        versions.
+        versions. Each string is space-separated, with no trailing space.
         '''
-        specific_line = ""
-        unversion_comment = ""
-        unversion_line = ""
-
-        for name, ver in self.install_packages.items():
-            specific_line += f"{name}={ver} "
+        specific_line = " ".join(f"{name}={ver}" for name, ver in self.install_packages.items())
 
+        unversion_comments = []
+        unversion_parts = []
         for name, new_ver in self.unversion_packages.items():
             old_ver = self.all_packages[name]
             if new_ver:
-                unversion_comment += f"{name}: {old_ver}->{new_ver} "
-                unversion_line += f"{name}={new_ver} "
+                unversion_comments.append(f"{name}: {old_ver}->{new_ver}")
+                unversion_parts.append(f"{name}={new_ver}")
             else:
-                unversion_comment += f"{name}: {old_ver}->? "
-                unversion_line += f"{name} "
+                unversion_comments.append(f"{name}: {old_ver}->?")
+                unversion_parts.append(name)
+        unversion_comment = " ".join(unversion_comments)
+        unversion_line = " ".join(unversion_parts)
 
         return specific_line, unversion_comment, unversion_line
 
 
+    def _build_verify_image(self):
+        '''
+        Makes self.image the base image with fresh apt indices, for verify installs to run in. Its
+        Dockerfile never changes, so after the first build (in this run or an earlier one) this
+        just reuses the tagged image; see _build_image.
+        '''
+        # Write prelude, create image
+        with open(os.path.join(self.tempdir, 'Dockerfile'), 'w') as dockerfile:
+            dockerfile.write(f"FROM {self.base_image}\n"
+                             f"ENV DEBIAN_FRONTEND=noninteractive\n"
+                             f"RUN apt-get update\n")
+            # I know this is supposed to go on the same line as the installs normally, but
+        self._build_image()
+
+
+    def _run_install(self, command):
+        '''
+        Runs command in a fresh container of self.image, which gets thrown away afterwards.
+        Returns everything the command wrote, as one string.
+        '''
+        container = self.docker_client.containers.run(self.image.id, command=command, detach=True)
+        try:
+            # Following the logs collects them as they come and returns once the container exits,
+            # so there's no separate wait, and they only get decoded once at the end
+            output = b"".join(container.logs(stream=True, follow=True))
+        finally:
+            container.remove(force=True)
+        return output.decode('utf-8', errors='replace')
+
+
     def verify_packages(self, mode=SystemAnalyzer.Mode.dry):
         '''
         Looks through package list to see which packages are uninstallable.
@@ -186,34 +339,19 @@ class UbuntuAnalyzer(SystemAnalyzer):
         '''
         assert self.install_packages, "No packages yet. Have you run get_packages?"
         logging.info(f"Verifying packages in {mode.name} mode...")
-        # Write prelude, create image
-        with open(os.path.join(self.tempdir, 'Dockerfile'), 'w') as dockerfile:
-            dockerfile.write(f"FROM {self.op_sys}:{self.version}\n")
-            dockerfile.write(f"ENV DEBIAN_FRONTEND=noninteractive\n")
-            dockerfile.write(f"RUN apt-get update\n")
-            # I know this is supposed to go on the same line as the installs normally, but
-        self.image, _ = self.docker_client.images.build(tag=f'verify{self.op_sys}',
-                                                        path=self.tempdir)
+        self._build_verify_image()
 
         # Try installing all of the packages
-        install_all = "apt-get install -y --allow-downgrades "
         pkg_line, _, unv_line = self._assemble_packages()
-        install_all += pkg_line + unv_line
+        install_all = f"{UbuntuAnalyzer.SIMULATE_INSTALL} {pkg_line} {unv_line}"
 
         # Spin up the container and try to install everything
-        try:
-            container = self.docker_client.containers.run(self.image.id, command=install_all,
-                                                          detach=True)
-            container.wait()
-            output = container.logs().decode()
-        finally:
-            container.remove(force=True)
+        output = self._run_install(install_all)
 
         # Parse the container's output
-        missing_pkgs = re.findall("E: Unable to locate package (.*)\n", output)
-        missing_vers = re.findall("' for '(.*)' was not found\n", output)
+        missing_pkgs, missing_vers, failed = UbuntuAnalyzer.parse_install_output(output)
 
-        if not re.search("E: ", output):
+        if not failed:
             logging.info("All packages installed properly.")
             return True
 
@@ -242,59 +380,24 @@ class UbuntuAnalyzer(SystemAnalyzer):
         Returns True if the fallback method was sufficient; False otherwise. (Dry mode, thus, is
         always false, since it never does anything.)
         '''
-        logging.info(f"Now running verification fallback in {mode.name} mode...")
-
-        if mode == self.Mode.dry:
-            logging.info("Dry mode does not take any fallback actions for missing packages.")
+        missing = self._start_fallback(missing, mode)
+        if missing is None:
             return False
 
-        if mode == self.Mode.delete:
-            logging.info(f"Now removing bad packages...")
-            for pkg_name in missing:
-                del self.install_packages[pkg_name]
-                try:
-                    del self.unversion_packages[pkg_name]
-                except KeyError:
-                    pass
-
-        if mode == self.Mode.unversion:
-            logging.info(f"Now removing version numbers from packages we couldn't find versions "
-                         "for...")
-            for pkg_name in missing:
-                del self.install_packages[pkg_name]
-                self.unversion_packages[pkg_name] = False
-
-        logging.info(f"Verifying packages after employing fallback...")
-
-        # Write prelude, create image
-        with open(os.path.join(self.tempdir, 'Dockerfile'), 'w') as dockerfile:
-            dockerfile.write(f"FROM {self.op_sys}:{self.version}\n")
-            dockerfile.write(f"ENV DEBIAN_FRONTEND=noninteractive\n")
-            dockerfile.write(f"RUN apt-get update\n")
-            # I know this is supposed to go on the same line as the installs normally, but
-        self.image, _ = self.docker_client.images.build(tag=f'verify{self.op_sys}',
-                                                        path=self.tempdir)
+        self._build_verify_image()
 
         # Try installing all of the packages
-        install_all = "apt-get install -y --allow-downgrades "
         pkg_line, _, unv_line = self._assemble_packages()
-        install_all += pkg_line + unv_line
+        install_all = f"{UbuntuAnalyzer.SIMULATE_INSTALL} {pkg_line} {unv_line}"
 
         # Spin up the container and try to install everything
-        try:
-            container = self.docker_client.containers.run(self.image.id, command=install_all,
-                                                          detach=True)
-            container.wait()
-            output = container.logs().decode()
-        finally:
-            container.remove(force=True)
+        output = self._run_install(install_all)
         logging.debug(output)
 
         # Parse the container's output
-        missing_pkgs = re.findall("E: Unable to locate package (.*)\n", output)
-        missing_vers = re.findall("' for '(.*)' was not found\n", output)
+        missing_pkgs, missing_vers, failed = UbuntuAnalyzer.parse_install_output(output)
 
-        if not re.search("E: ", output):
+        if not failed:
             logging.info("All packages installed properly after fallback.")
 
         if not missing_pkgs and not missing_vers:
@@ -306,31 +409,16 @@ class UbuntuAnalyzer(SystemAnalyzer):
         logging.warning(f"Could not find versions for the following packages during fallback: "
                         f"{missing_vers}")
 
-        # Now figure out what the versions for everything in unversion are
-        self.dockerize(self.tempdir, verbose=False)
-        container = self.docker_client.containers.run(self.image.id,
-                                                      command=self.LIST_INSTALLED,
-                                                      remove=True)
-        output = container.decode().split('\n')[:-1]
-        pkgs_after_fallback = self.parse_all_pkgs(output)
-        logging.info(f"Installed: {pkgs_after_fallback}")
-
-        recovered = set()
-        still_gone = set()
-
-        for package in missing:
-            if package in pkgs_after_fallback:
-                # Save the version number we found
-                self.unversion_packages[package] = pkgs_after_fallback[package]
-                recovered.add(package)
-            else:
-                still_gone.add(package)
-        logging.info(f"Recovered these packages via fallback strategy ({len(recovered)}): "
-                     f"{recovered}")
-        logging.info(f"Still missing ({len(still_gone)}): {still_gone}")
-
-        # Return True if we recovered everything
-        return len(still_gone) == 0
+        # Now figure out what the versions for everything in unversion are. A failed install
+        # installs nothing, so nothing was recovered; otherwise each package gets its candidate.
+        unversioned = [pkg for pkg in missing if pkg in self.unversion_packages]
+        if failed or not unversioned:
+            pkgs_after_fallback = {}
+        else:
+            pkgs_after_fallback = UbuntuAnalyzer.parse_policy(
+                self._run_install(f"apt-cache policy {' '.join(unversioned)}").splitlines())
+        logging.info(f"Would install: {pkgs_after_fallback}")
+        return self._finish_fallback(missing, pkgs_after_fallback)
 
 
     def dockerize(self, folder, verbose=True):
@@ -342,18 +430,17 @@ class UbuntuAnalyzer(SystemAnalyzer):
         verbose -- whether to emit log statements
         '''
         super().dockerize(folder, verbose)
+        specific, comment, unversion = self._assemble_packages()
+        contents = (f"FROM {self.base_image}\n"
+                    f"ENV DEBIAN_FRONTEND=noninteractive\n"
+                    f"RUN apt-get update && apt-get install -y --allow-downgrades {specific}\n")
+        if unversion != "":
+            contents += (f"# Original versions: {comment}\n"
+                         f"RUN apt-get update && apt-get install -y --allow-downgrades "
+                         f"{unversion}\n")
+
+        # Write the whole file in one go
         with open(os.path.join(folder, 'Dockerfile'), 'w') as dockerfile:
-            dockerfile.write(f"FROM {self.op_sys}:{self.version}\n")
-
-            dockerfile.write(f"ENV DEBIAN_FRONTEND=noninteractive\n")
-
-            specific, comment, unversion = self._assemble_packages()
-            dockerfile.write(f"RUN apt-get update && apt-get install -y --allow-downgrades "
-                             f"{specific}\n")
-
-            if unversion != "":
-                dockerfile.write(f"# Original versions: {comment}\n")
-                dockerfile.write(f"RUN apt-get update && apt-get install -y --allow-downgrades "
-                                 f"{unversion}\n")
+            dockerfile.write(contents)
         if verbose:
             logging.info(f"Your Dockerfile is in {folder}")
@@ -3,8 +3,9 @@ Provides structures, custom errors, and global helper functions for the rest of
 '''
 
 import logging
+import queue
 
-from typing import NamedTuple
+from typing import NamedTuple, Optional
 import networkx as nx
 
 
@@ -16,6 +17,12 @@ class Host(NamedTuple):
     username: str
 
 
+class FileHash(NamedTuple):
+    '''A file's checksum, and its size if the hasher reported one (otherwise None)'''
+    hash: str
+    size: Optional[str]
+
+
 class DockerDaemonError(Exception):
     '''Cannot reach the Docker daemon.'''
 
@@ -37,19 +44,113 @@ class PermissionsError(OrigSysError):
     # f"Insufficient permissions on the target system for {user}."
 
 
-def group_strings(indexable, char_count=100000):
+class ChannelPool:
+    '''
+    Keeps several shells open on one SSH connection so that commands don't each pay for opening a
+    new channel. Commands are framed with a sentinel so we know where their output ends.
+    '''
+    SENTINEL = '__END__'
+    CHUNK_SIZE = 65536
+
+    def __init__(self, ssh_client, size=8):
+        '''
+        ssh_client -- a connected paramiko SSHClient
+        size -- how many channels to keep open; keep this below the server's MaxSessions (10 by
+                default on OpenSSH)
+        '''
+        self.size = size
+        self._transport = ssh_client.get_transport()
+        self._channels = queue.Queue()
+        for _ in range(size):
+            self._channels.put(self._open_channel())
+
+
+    def _open_channel(self):
+        '''
+        Opens a channel running a shell to send commands to.
+        Returns a tuple of the channel and a file for writing to its stdin.
+        '''
+        channel = self._transport.open_session()
+        channel.exec_command('bash -s')
+        return channel, channel.makefile('wb')
+
+
+    def run(self, cmd):
+        '''
+        Runs cmd on the next free channel, blocking until one is available. Anything the command
+        writes to stderr is discarded.
+        Returns a list of the lines the command wrote to stdout.
+        '''
+        return self.run_raw(cmd).splitlines(keepends=True)
+
+
+    def run_raw(self, cmd):
+        '''
+        Like run, but returns everything the command wrote to stdout as a single string.
+        Raises OrigSysConnError if the channel closes before the command finishes.
+        '''
+        marker = ChannelPool.SENTINEL.encode()
+        channel, stdin = self._channels.get()
+        try:
+            # The sentinel goes on a line of its own, even if the output didn't end in a newline.
+            # The command gets no stdin; otherwise it could eat the rest of what we send the shell,
+            # sentinel included, and we'd wait forever.
+            stdin.write(f"{{ {cmd}\n}} </dev/null 2>/dev/null; "
+                        f"printf '\\n{ChannelPool.SENTINEL}%s__\\n' $?\n")
+            stdin.flush()
+            # Read in big chunks rather than line by line; the sentinel line is always last.
+            data = bytearray()
+            end = -1
+            while end < 0:
+                chunk = channel.recv(ChannelPool.CHUNK_SIZE)
+                if not chunk:
+                    raise OrigSysConnError(f"Lost the SSH channel while running: {cmd}")
+                data += chunk
+                if data.endswith(b'__\n'):
+                    # Only a sentinel at the start of the final line counts; the command's own
+                    # output might contain one too
+                    last_line = data.rfind(b'\n', 0, len(data) - 1) + 1
+                    if data.startswith(marker, last_line):
+                        end = last_line
+        except Exception:
+            # Whatever's left of this command's output would end up in the next one's, so don't
+            # reuse the channel
+            channel.close()
+            try:
+                self._channels.put(self._open_channel())
+            except Exception: # pylint: disable=broad-except
+                # The connection is gone. Hand back the dead channel so that later commands fail
+                # straight away rather than waiting forever for a free one.
+                self._channels.put((channel, stdin))
+            raise
+        self._channels.put((channel, stdin))
+        # Drop the newline that went out before the sentinel
+        return data[:end - 1].decode()
+
+
+    def close(self):
+        '''Closes all channels in the pool.'''
+        while not self._channels.empty():
+            channel, _ = self._channels.get()
+            channel.close()
+
+
+def group_strings(indexable, char_count=100000, sep=' '):
     '''
-    Generator to group the indexable's items into space-separated strings which are about char_count
-    characters long.
+    Generator to group the indexable's items into strings which are at most about char_count
+    characters long, with sep between the items (e.g. ' ; ' to chain shell commands).
     '''
-    curr_string = ""
+    buf = []
+    length = 0
     for item in indexable:
-        if len(curr_string) > char_count:
-            yield curr_string
-            curr_string = ""
-        curr_string += item + " "
-    if curr_string:
-        yield curr_string
+        if buf and length + len(item) > char_count:
+            yield sep.join(buf)
+            buf = []
+            length = 0
+        buf.append(item)
+        length += len(item) + len(sep)
+    if buf:
+        yield sep.join(buf)
 
 
 def analyze_dependencies(nodes, get_deps_func):
@@ -63,28 +164,23 @@ def analyze_dependencies(nodes, get_deps_func):
     full_g = nx.DiGraph()
     full_g.add_nodes_from(nodes)
 
-    # Process the edges based on the dependency function
-    for node in full_g:
-        deps = get_deps_func(node)
-        for dep in deps:
-            if dep in full_g:
-                full_g.add_edge(node, dep)
+    # Process the edges based on the dependency function. Each node's deps are asked for exactly
+    # once, so there are no shared subtrees to re-resolve.
+    full_g.add_edges_from((node, dep) for node in node_set for dep in get_deps_func(node)
+                          if dep in node_set)
 
     # Filter the nodes and return them
     filtered_pkgs = {node for node, in_degree in full_g.in_degree() if in_degree == 0}
 
     # Find any strongly connected components with size greater than 1
-    # These will all have in degree > 0, but should still be included
-    g_list = [sub_g for sub_g in
-              [full_g.subgraph(comp) for comp in nx.strongly_connected_components(full_g)]
-              if sub_g.number_of_nodes() > 1]
-
-    for sub_g in g_list:
-        # Only counts if it was the original list
-        nodes = [node for node in sub_g.nodes() if node in node_set]
-        if len(nodes) > 0:
-            logging.debug(f"Strongly connected component: {repr(nodes)}")
-            for node in nodes:
-                filtered_pkgs.add(node)
+    # These will all have in degree > 0, but should still be included. Look at the components
+    # directly rather than building a subgraph view of each one.
+    for comp in nx.strongly_connected_components(full_g):
+        if len(comp) > 1:
+            # Only counts if it was the original list
+            nodes = comp & node_set
+            if nodes:
+                logging.debug(f"Strongly connected component: {repr(nodes)}")
+                filtered_pkgs |= nodes
 
     return node_set - filtered_pkgs
@@ -0,0 +1,111 @@
+'''
+Provides tests for ChannelPool's framing of command output, using fake SSH channels.
+'''
+
+import pytest
+
+from analyzer.utils import ChannelPool, OrigSysConnError
+
+
+
+class FakeChannel:
+    '''Hands back canned chunks of output, one per recv, and then nothing (i.e. closed).'''
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.written = []
+        self.closed = False
+
+    def exec_command(self, command):
+        '''Pretends to start command.'''
+
+    def makefile(self, mode):
+        '''Returns the channel itself as its stdin.'''
+        assert mode == 'wb'
+        return self
+
+    def write(self, data):
+        '''Remembers what got sent.'''
+        self.written.append(data)
+
+    def flush(self):
+        '''Nothing to flush.'''
+
+    def recv(self, size):
+        '''Returns the next canned chunk, or b'' once they run out.'''
+        assert size > 0
+        return self.chunks.pop(0) if self.chunks else b''
+
+    def close(self):
+        '''Marks the channel closed.'''
+        self.closed = True
+
+
+class FakeSSHClient:
+    '''Opens FakeChannels, each serving the next list of chunks given.'''
+    def __init__(self, *outputs):
+        self.outputs = list(outputs)
+        self.opened = []
+
+    def get_transport(self):
+        '''The client doubles as its own transport.'''
+        return self
+
+    def open_session(self):
+        '''Opens a channel with the next canned output.'''
+        channel = FakeChannel(self.outputs.pop(0) if self.outputs else [])
+        self.opened.append(channel)
+        return channel
+
+
+def run_one(chunks):
+    '''Runs a command on a one-channel pool whose channel replies with chunks.'''
+    pool = ChannelPool(FakeSSHClient(chunks), size=1)
+    return pool.run_raw('true')
+
+
+def test_split_across_chunks():
+    '''
+    Test that output split over several recvs, sentinel included, is put back together.
+    '''
+    chunks = [b'first li', b'ne\nsecond line\n', b'\n__EN', b'D__0__\n']
+    assert run_one(chunks) == 'first line\nsecond line\n'
+
+
+def test_no_trailing_newline():
+    '''
+    Test that output that doesn't end in a newline comes back as is.
+    '''
+    assert run_one([b'no newline', b'\n__END__0__\n']) == 'no newline'
+    assert run_one([b'\n__END__1__\n']) == ''
+
+
+def test_boundary_after_frame_line():
+    '''
+    Test that a chunk ending right after a framing line (e.g. __SEP__x__ from the bulk queries), or
+    after a line with the sentinel somewhere other than its start, doesn't end the command early.
+    '''
+    chunks = [b'__SEP__x__\n', b'saw __END__0__\n', b'/etc/x\n', b'\n__END__0__\n']
+    assert run_one(chunks) == '__SEP__x__\nsaw __END__0__\n/etc/x\n'
+
+
+def test_closed_channel():
+    '''
+    Test that a channel closing mid-command raises rather than returning partial output, and that
+    the pool swaps in a fresh channel for the next command.
+    '''
+    client = FakeSSHClient([b'partial output\n'], [b'ok\n', b'\n__END__0__\n'])
+    pool = ChannelPool(client, size=1)
+    with pytest.raises(OrigSysConnError):
+        pool.run_raw('true')
+    assert client.opened[0].closed
+    assert pool.run('true') == ['ok\n']
+
+
+def test_command_gets_no_stdin():
+    '''
+    Test that commands run with stdin from /dev/null, so that one that reads stdin can't swallow
+    the sentinel meant for the shell.
+    '''
+    client = FakeSSHClient([b'\n__END__0__\n'])
+    ChannelPool(client, size=1).run_raw('head -c 5')
+    assert '} </dev/null ' in ''.join(client.opened[0].written)
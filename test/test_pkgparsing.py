@@ -7,37 +7,6 @@ from analyzer.system.ubuntu import UbuntuAnalyzer
 
 
 
-def test_centos_basic_parse():
-    '''
-    Test that lines of the form 'curl.x86_64   7.29.0-42.el7' are parsed correctly
-    '''
-    line = 'curl.x86_64   7.29.0-42.el7'
-    pkg_name, pkg_version = CentosAnalyzer.parse_pkg_line(line)
-    assert pkg_name == 'curl'
-    assert pkg_version == '7.29.0'
-
-
-def test_centos_epoch_parse():
-    '''
-    Test that epoch numbers dont mess with parsing 'curl.x86_64   1:7.29.0-42.el7'
-    '''
-    line = 'curl.x86_64   1:7.29.0-42.el7'
-    pkg_name, pkg_version = CentosAnalyzer.parse_pkg_line(line)
-    assert pkg_name == 'curl'
-    assert pkg_version == '7.29.0'
-
-
-def test_centos_extra_dash_parse():
-    '''
-    Test that the edge case with extra dashes we missed the first time around is handled:
-    'java-1.8.0-openjdk.x86_64   1:1.8.0.212.b04-0.el7_6'
-    '''
-    line = 'java-1.8.0-openjdk.x86_64   1:1.8.0.212.b04-0.el7_6'
-    pkg_name, pkg_version = CentosAnalyzer.parse_pkg_line(line)
-    assert pkg_name == 'java-1.8.0-openjdk'
-    assert pkg_version == '1.8.0.212.b04'
-
-
 def test_ubuntu_parse():
     '''
     Test that lines of the form
@@ -53,3 +22,134 @@ def test_ubuntu_parse():
     assert pkg1_version == '1:2.4.0-1~18.04.1'
     assert pkg2_name == 'yelp'
     assert pkg2_version == '3.26.0-1ubuntu2'
+
+
+def test_centos_bulk_query_parse():
+    '''
+    Test that batched rpm query output framed by __SEP__pkg__ lines is split per package, including
+    packages with no output.
+    '''
+    lines = ['__SEP__curl__\n', 'libcurl = 7.29.0-42.el7\n', 'rtld(GNU_HASH)\n',
+             '__SEP__empty__\n',
+             '__SEP__java-1.8.0-openjdk__\n', 'jpackage-utils\n', '\n']
+    results = CentosAnalyzer.parse_bulk_query(lines)
+    assert results == {'curl': {'libcurl = 7.29.0-42.el7', 'rtld(GNU_HASH)'},
+                       'empty': set(),
+                       'java-1.8.0-openjdk': {'jpackage-utils'}}
+
+
+def test_centos_file_listing_parse():
+    '''
+    Test that rpm -ql output framed by __PKG__index__ lines lands in the right slot, and that blank
+    lines and "contains no files" messages don't shift later packages.
+    '''
+    output = ('__PKG__0__\n/usr/bin/curl\n\n/usr/share/man/man1/curl.1.gz\n'
+              '__PKG__1__\n(contains no files)\n'
+              '__PKG__2__\n/etc/yum.conf\n')
+    files = CentosAnalyzer.parse_file_listing(output, 3)
+    assert files == [['/usr/bin/curl', '/usr/share/man/man1/curl.1.gz'], [], ['/etc/yum.conf']]
+    assert files[0] is not files[1]
+
+
+def test_centos_list_installed_parse():
+    '''
+    Test that rpm -qa --queryformat '%{NAME} %{VERSION}\n' output is parsed, including names with
+    dots and dashes, and that blank lines and GPG keys are skipped.
+    '''
+    lines = ['curl 7.29.0\n', 'java-1.8.0-openjdk 1.8.0.212.b04\n', '\n', 'python3.6 3.6.8\n',
+             'gpg-pubkey f4a80eb5\n', 'gpg-pubkey 352c64e5\n']
+    packages = CentosAnalyzer.parse_all_pkgs(lines)
+    assert packages == {'curl': '7.29.0', 'java-1.8.0-openjdk': '1.8.0.212.b04',
+                        'python3.6': '3.6.8'}
+
+
+def test_ubuntu_conffiles_parse():
+    '''
+    Test that batched dpkg-query ${Conffiles} output framed by __SEP__pkg__ lines is split per
+    package, that multiarch packages are merged, and that obsolete conffiles are skipped.
+    '''
+    lines = ['__SEP__bash__\n', ' /etc/bash.bashrc 89269e1298235f1b12b4c16e4065ad0d\n',
+             ' /etc/skel/.bashrc ee35a240758f374832e809ae0ea4883a\n',
+             '__SEP__coreutils__\n', '\n',
+             '__SEP__libpam0g__\n', ' /etc/pam.conf 87fc76f18e98ee7d3848f6b81b3391e5 obsolete\n',
+             '__SEP__libc6__\n', ' /etc/ld.so.conf.d/x86_64-linux-gnu.conf d4e7a7b88a71b5ff\n',
+             '__SEP__libc6__\n', ' /etc/ld.so.conf.d/i386-linux-gnu.conf 6b9ea3cf4a4f1bc5\n']
+    results = UbuntuAnalyzer.parse_conffiles(lines)
+    assert results == {'bash': {'/etc/bash.bashrc', '/etc/skel/.bashrc'},
+                       'coreutils': set(),
+                       'libpam0g': set(),
+                       'libc6': {'/etc/ld.so.conf.d/x86_64-linux-gnu.conf',
+                                 '/etc/ld.so.conf.d/i386-linux-gnu.conf'}}
+
+
+def test_ubuntu_file_listing_parse():
+    '''
+    Test that dpkg-query -L output framed by __PKG__index__ lines lands in the right slot even when
+    a package lists nothing, that directories holding other files from the same package are
+    dropped while empty ones are kept, and that dpkg's messages aren't taken for files.
+    '''
+    output = ('__PKG__0__\n/.\n/usr\n/usr/bin\n/usr/bin/yelp\n/usr/share/yelp\n\n'
+              '__PKG__1__\n'
+              '__PKG__2__\n/.\n/etc\n/etc/bash.bashrc\n/usr/share/bash\n/usr/share/bash/x\n'
+              'diverted by dash to: /usr/share/bash/x.distrib\n')
+    files = UbuntuAnalyzer.parse_file_listing(output, 3)
+    assert files == [['/usr/bin/yelp', '/usr/share/yelp'], [],
+                     ['/etc/bash.bashrc', '/usr/share/bash/x']]
+    assert files[1] is not files[2]
+
+
+def test_ubuntu_depends_parse():
+    '''
+    Test that apt-cache depends output for several packages is split on the unindented package
+    lines, keeping Depends and PreDepends but not Recommends.
+    '''
+    lines = ['bash\n', '  PreDepends: libc6\n', '  PreDepends: libtinfo5\n',
+             '  Depends: base-files\n', '  Recommends: bash-completion\n',
+             '  Depends: base-files\n',
+             'yelp\n', ' |Depends: yelp-xsl\n', '  Depends: <gnome-help>\n',
+             'empty\n']
+    results = UbuntuAnalyzer.parse_depends(lines)
+    assert results == {'bash': {'libc6', 'libtinfo5', 'base-files'},
+                       'yelp': {'yelp-xsl', '<gnome-help>'},
+                       'empty': set()}
+
+
+def test_ubuntu_verify_parse():
+    '''
+    Test that batched dpkg --verify output framed by __SEP__pkg__ lines is split per package, that
+    only checksum mismatches count, and that conffile and plain file lines are both handled.
+    '''
+    lines = ['__SEP__bash__\n', '??5?????? c /etc/bash.bashrc\n', '??5??????   /bin/bash\n',
+             'missing     /usr/share/doc/bash/README\n',
+             '__SEP__yelp__\n',
+             '__SEP__gone__\n', "dpkg: package 'gone' is not installed\n"]
+    results = UbuntuAnalyzer.parse_verify(lines)
+    assert results == {'bash': {'/etc/bash.bashrc', '/bin/bash'}, 'yelp': set(), 'gone': set()}
+
+
+def test_ubuntu_policy_parse():
+    '''
+    Test that apt-cache policy output for several packages is split on the unindented package
+    lines, that only candidate versions are kept, and that packages without one are left out.
+    '''
+    lines = ['yelp:', '  Installed: (none)', '  Candidate: 3.26.0-1ubuntu2', '  Version table:',
+             '     3.26.0-1ubuntu2 500', '        500 http://archive.ubuntu.com bionic/main',
+             'ghost:', '  Installed: (none)', '  Candidate: (none)', '  Version table:',
+             'N: Unable to locate package nothere']
+    results = UbuntuAnalyzer.parse_policy(lines)
+    assert results == {'yelp': '3.26.0-1ubuntu2'}
+
+
+def test_ubuntu_install_output_parse():
+    '''
+    Test that apt-get install output is scanned for missing packages, missing versions, and other
+    errors, and that clean output isn't taken for a failure.
+    '''
+    output = ('Reading package lists...\n'
+              "E: Version '1.0-1' for 'yelp' was not found\n"
+              'E: Unable to locate package nothere\n')
+    assert UbuntuAnalyzer.parse_install_output(output) == (['nothere'], ['yelp'], True)
+    output = 'E: Unable to correct problems, you have held broken packages.\n'
+    assert UbuntuAnalyzer.parse_install_output(output) == ([], [], True)
+    output = 'Reading package lists...\nInst yelp (3.26.0-1ubuntu2 Ubuntu:18.04/bionic [amd64])\n'
+    assert UbuntuAnalyzer.parse_install_output(output) == ([], [], False)